@@ -0,0 +1,109 @@
+#
+#  Copyright (C) 2019-2020  XC Software (Shenzhen) Ltd.
+#
+
+
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+from common.CommonGlobals import TaskErrorNo
+from common.XcalException import XcalException
+from common.XcalLogger import XcalLogger
+
+
+class MemoryAdmissionController(object):
+    """
+    Admit memory-hungry subprocesses (e.g. JVMs) against a memory budget of the host.
+    Each process reserves its amount before starting, and waits until enough
+    budget is released by the processes that finished. An optional host_ready
+    check (e.g. on a SystemSampler snapshot) also holds back processes while
+    the host is busy with work outside of this controller.
+    """
+
+    HEAP_UNITS_MB = {"": 1.0 / (1024 * 1024), "k": 1.0 / 1024, "m": 1, "g": 1024, "t": 1024 * 1024}
+
+    def __init__(self, budget_mb: int, logger: XcalLogger = None, host_ready=None, recheck_interval: float = 1.0):
+        """
+        :param budget_mb: total amount of memory, in MB, that may be reserved at the same time
+        :param logger: XcalLogger of parent
+        :param host_ready: callable returning False while the host is too busy to start another process
+        :param recheck_interval: seconds between two host_ready checks of a waiting process
+        """
+        self.budget_mb = budget_mb
+        self.reserved_mb = 0
+        self.running = 0
+        self.logger = logger
+        self.host_ready = host_ready
+        self.recheck_interval = recheck_interval
+        self.condition = threading.Condition()
+
+    def _fits(self, amount_mb: int):
+        # Admitted when nothing else runs, so a request larger than the budget, or a host
+        # kept busy by others, never starves
+        if self.running == 0:
+            return True
+        if self.reserved_mb + amount_mb > self.budget_mb:
+            return False
+        return self.host_ready is None or self.host_ready()
+
+    def acquire(self, amount_mb: int, timeout: float = None):
+        """
+        Block until amount_mb can be reserved against the budget
+        :param amount_mb: amount of memory to reserve, in MB
+        :param timeout: maximum seconds to wait, None to wait until admitted
+        :return: True if reserved, False if timeout expired
+        """
+        with self.condition:
+            if not self._fits(amount_mb) and self.logger is not None:
+                self.logger.info("admission-wait", "Waiting for %d MB, reserved %d / %d MB" %
+                                 (amount_mb, self.reserved_mb, self.budget_mb))
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while not self._fits(amount_mb):
+                # Released budget wakes us up, host readiness is polled
+                wait_time = None if self.host_ready is None else self.recheck_interval
+                if deadline is not None:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        return False
+                    wait_time = remaining if wait_time is None else min(wait_time, remaining)
+                self.condition.wait(wait_time)
+            self.reserved_mb += amount_mb
+            self.running += 1
+            return True
+
+    def release(self, amount_mb: int):
+        """
+        Give back a reservation made by acquire, waking up the waiting processes
+        :param amount_mb: amount of memory reserved, in MB
+        """
+        with self.condition:
+            self.reserved_mb -= amount_mb
+            self.running -= 1
+            self.condition.notify_all()
+
+    @contextmanager
+    def reserve(self, amount_mb: int):
+        """
+        Reserve amount_mb for the duration of the with-block
+        """
+        self.acquire(amount_mb)
+        try:
+            yield self
+        finally:
+            self.release(amount_mb)
+
+    @staticmethod
+    def parse_jvm_heap(heap_option: str):
+        """
+        Convert a JVM maximum heap option (e.g. -Xmx12240m, -Xmx12g) to MB
+        :param heap_option: the -Xmx option
+        :return: (int) heap size in MB
+        """
+        res = re.match(r"^\s*(?:-Xmx)?([0-9]+)([kKmMgGtT]?)\s*$", heap_option)
+        if res is None:
+            raise XcalException("MemoryAdmissionController", "parse_jvm_heap",
+                                "cannot parse jvm heap option: %s" % heap_option,
+                                TaskErrorNo.E_CONFIG_PARM_ERROR)
+        return max(1, int(int(res.group(1)) * MemoryAdmissionController.HEAP_UNITS_MB[res.group(2).lower()]))
@@ -0,0 +1,97 @@
+#
+#  Copyright (C) 2019-2020  XC Software (Shenzhen) Ltd.
+#
+
+
+import fnmatch
+import os
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+LIB_LIST_SUFFIX = ".lib.list"
+DIR_LIST_SUFFIX = ".dir.list"
+
+# Directory names never holding plugin results: VCS metadata, node packages and class-file output trees
+DEFAULT_PRUNE_PATTERNS = (".git", ".svn", ".hg", "node_modules", "classes", "test-classes")
+
+
+class ArtifactDiscovery(object):
+    """
+    Single pass discovery of the files with given suffixes under an artifact root,
+    built on os.scandir, pruning directories by name and optionally scanning
+    directories in parallel (useful on network file systems).
+    """
+
+    def __init__(self, suffixes: tuple, prune_patterns: tuple = DEFAULT_PRUNE_PATTERNS, workers: int = 1):
+        """
+        :param suffixes: file name suffixes to collect
+        :param prune_patterns: fnmatch patterns of directory names not to enter
+        :param workers: number of directories scanned at the same time
+        """
+        self.suffixes = tuple(suffixes)
+        self.prune_patterns = tuple(prune_patterns)
+        self.workers = max(1, workers)
+
+    def _pruned(self, dir_name: str):
+        return any(fnmatch.fnmatchcase(dir_name, one_pattern) for one_pattern in self.prune_patterns)
+
+    def _scan_dir(self, path: str):
+        """
+        :return: ([(suffix, file path)] matching in path, [sub-directories to scan])
+        """
+        matches = []
+        sub_dirs = []
+        try:
+            with os.scandir(path) as entries:
+                for one_entry in entries:
+                    if one_entry.is_dir(follow_symlinks=False):
+                        if not self._pruned(one_entry.name):
+                            sub_dirs.append(one_entry.path)
+                    elif one_entry.name.endswith(self.suffixes):
+                        for one_suffix in self.suffixes:
+                            if one_entry.name.endswith(one_suffix):
+                                matches.append((one_suffix, one_entry.path))
+                                break
+        except (PermissionError, FileNotFoundError, NotADirectoryError):
+            # Same as os.walk, unreadable or vanished directories are skipped
+            pass
+        return matches, sub_dirs
+
+    def scan(self, root: str):
+        """
+        :return: {suffix: sorted list of file paths} for all suffixes
+        """
+        found = dict((one_suffix, []) for one_suffix in self.suffixes)
+        if self.workers == 1:
+            pending = [root]
+            while pending:
+                matches, sub_dirs = self._scan_dir(pending.pop())
+                for one_suffix, one_path in matches:
+                    found[one_suffix].append(one_path)
+                pending.extend(sub_dirs)
+        else:
+            with ThreadPoolExecutor(max_workers=self.workers) as pool:
+                pending = {pool.submit(self._scan_dir, root)}
+                while pending:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for one_future in done:
+                        matches, sub_dirs = one_future.result()
+                        for one_suffix, one_path in matches:
+                            found[one_suffix].append(one_path)
+                        pending.update(pool.submit(self._scan_dir, one_dir) for one_dir in sub_dirs)
+
+        for one_suffix in self.suffixes:
+            found[one_suffix].sort()
+        return found
+
+    @staticmethod
+    def find_list_pairs(root: str, prune_patterns: tuple = DEFAULT_PRUNE_PATTERNS, workers: int = 1):
+        """
+        Pair the .lib.list and .dir.list files generated by the plugin for each module
+        :return: (sorted list of module prefixes having both files, prefixes with a .lib.list only,
+                  prefixes with a .dir.list only), prefixes being the list file paths without suffix
+        """
+        found = ArtifactDiscovery((LIB_LIST_SUFFIX, DIR_LIST_SUFFIX), prune_patterns, workers).scan(root)
+        lib_prefixes = set(one_path[:-len(LIB_LIST_SUFFIX)] for one_path in found[LIB_LIST_SUFFIX])
+        dir_prefixes = set(one_path[:-len(DIR_LIST_SUFFIX)] for one_path in found[DIR_LIST_SUFFIX])
+        return (sorted(lib_prefixes & dir_prefixes), sorted(lib_prefixes - dir_prefixes),
+                sorted(dir_prefixes - lib_prefixes))
@@ -3,21 +3,60 @@
 #
 
 
+import asyncio
+import collections
 import os
+import signal
 import subprocess
+import sys
 import tempfile
+import threading
 import time
 
+import psutil
+
 from common.CommonGlobals import TaskErrorNo
 from common.XcalException import XcalException
 from common.XcalLogger import XcalLogger
 
 
+# Resource usage of a subprocess and its descendants, as sampled while it was running
+ProcessUsage = collections.namedtuple("ProcessUsage", ["wall_time", "max_rss", "cpu_time"])
+
+
+class OutputTail(object):
+    """
+    Bounded in-memory buffer keeping the last max_size bytes of a subprocess output,
+    so that a failure can be reported without reading back the whole log file.
+    """
+
+    def __init__(self, max_size:int):
+        self.max_size = max_size
+        self.chunks = collections.deque()
+        self.size = 0
+
+    def append(self, chunk:bytes):
+        self.chunks.append(chunk)
+        self.size += len(chunk)
+        while self.size - len(self.chunks[0]) >= self.max_size:
+            self.size -= len(self.chunks.popleft())
+
+    def getvalue(self):
+        """
+        :return: (bytes) the last max_size bytes of the output
+        """
+        return b"".join(self.chunks)[-self.max_size:]
+
+
 class CommandLineUtility(object):
+    READ_SIZE = 64 * 1024  # In bytes
+    KILL_GRACE_PERIOD = 5  # In seconds
+    USAGE_SAMPLE_INTERVAL = 1  # In seconds
+    EXIT_POLL_INTERVAL = 0.05  # In seconds
 
     @staticmethod
     def bash_execute(command:str, timeout:float, logger:XcalLogger, logfile:str = None, environment:dict = None,
-                     need_display:bool = True):
+                     need_display:bool = True, output_tail:OutputTail = None):
         """
         Invoke the shell/command line utility to execute command,
                     which may need proper privileges
@@ -28,6 +67,7 @@ class CommandLineUtility(object):
         :param logger:    XcalLogger
         :param environment: environment variables to pass down.
         :param need_display: whether to display the output of the subprocess to logs/screen
+        :param output_tail: OutputTail receiving the output of the subprocess, besides the log file
         :return: (int) the return code from the subprocess.
         """
         with XcalLogger("CommandLineUtility", "bash_execute", parent=logger) as log:
@@ -47,29 +87,37 @@ class CommandLineUtility(object):
 
             # Invoking Process --------------------------
             with open(out_fn, "a+b") as out_f:
-                out_f.write("\n---- execution command ------ \n".encode("UTF-8"))
-                out_f.write(str(command).encode("UTF-8"))
-                out_f.write(("\n----- saving dump to file -----\n" + out_fn).encode("UTF-8"))
-                out_f.write("\n----- environment: -----\n".encode("UTF-8"))
-                out_f.write(str(environment).encode("UTF-8"))
-                out_f.write("\n-------------------\n".encode("UTF-8"))
-                out_f.flush()
-
-                if timeout is not None:
-                    endtime = time.monotonic() + timeout
-
-                process = subprocess.Popen(command, shell = True, universal_newlines = True, stdout = subprocess.PIPE,
+                CommandLineUtility._write_header(out_f, command, out_fn, environment)
+
+                endtime = None if timeout is None else time.monotonic() + timeout
+
+                # The command runs in its own process group, so that it can be killed with all its descendants
+                process = subprocess.Popen(command, shell = True, stdout = subprocess.PIPE,
                                            stderr = subprocess.STDOUT,
-                                           env = environment)
-                while True:
-                    line = process.stdout.readline()
-                    if line == '' and process.poll() is not None:
-                        break
-                    if need_display and line:
-                        log.trace("[output]", line.strip())
-                    CommandLineUtility._check_timeout(endtime, timeout)
-
-                rc = process.poll()
+                                           env = environment, **CommandLineUtility._process_group_kwargs())
+                reader = threading.Thread(target = CommandLineUtility._pump_output,
+                                          args = (process.stdout, out_f, log if need_display else None,
+                                                  output_tail),
+                                          daemon = True)
+                reader.start()
+                try:
+                    # The deadline is enforced whether the command prints anything or not
+                    rc = process.wait(timeout = timeout)
+                except subprocess.TimeoutExpired:
+                    CommandLineUtility.kill_process_group(process)
+                    reader.join(CommandLineUtility.KILL_GRACE_PERIOD)
+                    out_f.write(("execution command timeout: %s\n" % timeout).encode("UTF-8"))
+                    raise XcalException("CommandLineUtility", "bash_execute", "timeout: %s" % timeout,
+                                        TaskErrorNo.E_COMMON_TIMEOUT)
+
+                # The rest of the output is drained shortly, unless descendants keep it open
+                reader.join(min(CommandLineUtility.KILL_GRACE_PERIOD, CommandLineUtility._remaining(endtime))
+                            if endtime is not None else CommandLineUtility.KILL_GRACE_PERIOD)
+                if reader.is_alive():
+                    # Descendants still hold the output open after the command exited
+                    CommandLineUtility.kill_process_group(process)
+                    reader.join(CommandLineUtility.KILL_GRACE_PERIOD)
+
                 out_f.write(("execution command return code: %s\n" % rc).encode("UTF-8"))
 
             if tempfile_used:
@@ -79,10 +127,238 @@ class CommandLineUtility(object):
             return rc
 
     @staticmethod
-    def _check_timeout(endtime, orig_timeout):
-        """Convenience for checking if a timeout has expired."""
+    async def async_bash_execute(command:str, timeout:float, logger:XcalLogger, logfile:str = None,
+                                 environment:dict = None, need_display:bool = True, output_tail:OutputTail = None):
+        """
+        asyncio counterpart of bash_execute, so that one event loop can supervise many subprocesses.
+        Same log file, environment and timeout semantics, including killing the process group on timeout.
+        :param command:  command line to execute, run by the shell
+        :param timeout:  timeout, in seconds
+        :param logger:    XcalLogger
+        :param logfile:  file name to the log file of the process, a temporary file if None
+        :param environment: environment variables to pass down.
+        :param need_display: whether to display the output of the subprocess to logs/screen
+        :param output_tail: OutputTail receiving the output of the subprocess, besides the log file
+        :return: (int, ProcessUsage) the return code and the resource usage of the subprocess.
+        """
+        with XcalLogger("CommandLineUtility", "async_bash_execute", parent=logger) as log:
+            out_fn = logfile
+            local_temp_file = None
+
+            if environment is None:
+                environment = dict(os.environ)
+
+            if out_fn is None:
+                local_temp_file = tempfile.NamedTemporaryFile(mode="w+b")
+                out_fn = local_temp_file.name
+
+            log.info("execution command", command)
+            log.info("dump to file", ("file name :", out_fn))
+
+            with open(out_fn, "a+b") as out_f:
+                CommandLineUtility._write_header(out_f, command, out_fn, environment)
+
+                start_time = time.monotonic()
+                endtime = None if timeout is None else start_time + timeout
+                process = await asyncio.create_subprocess_exec(*CommandLineUtility._shell_command(command),
+                                                               stdout = asyncio.subprocess.PIPE,
+                                                               stderr = asyncio.subprocess.STDOUT,
+                                                               env = environment,
+                                                               **CommandLineUtility._process_group_kwargs())
+                usage = {"max_rss": 0, "cpu_time": 0.0}
+                pump = asyncio.ensure_future(
+                    CommandLineUtility._async_pump_output(process.stdout, out_f, log if need_display else None,
+                                                          output_tail))
+                sampler = asyncio.ensure_future(CommandLineUtility._async_sample_usage(process.pid, usage))
+                try:
+                    # The deadline is enforced whether the command prints anything or not
+                    rc = await asyncio.wait_for(CommandLineUtility._async_wait_exit(process), timeout)
+                except asyncio.TimeoutError:
+                    await CommandLineUtility._async_kill_process_group(process)
+                    pump.cancel()
+                    out_f.write(("execution command timeout: %s\n" % timeout).encode("UTF-8"))
+                    raise XcalException("CommandLineUtility", "async_bash_execute", "timeout: %s" % timeout,
+                                        TaskErrorNo.E_COMMON_TIMEOUT)
+                finally:
+                    sampler.cancel()
+
+                # The rest of the output is drained shortly, unless descendants keep it open
+                grace = CommandLineUtility.KILL_GRACE_PERIOD
+                if endtime is not None:
+                    grace = min(grace, CommandLineUtility._remaining(endtime))
+                try:
+                    await asyncio.wait_for(asyncio.shield(pump), grace)
+                except asyncio.TimeoutError:
+                    # Descendants still hold the output open after the command exited
+                    await CommandLineUtility._async_kill_process_group(process)
+                    try:
+                        await asyncio.wait_for(pump, CommandLineUtility.KILL_GRACE_PERIOD)
+                    except asyncio.TimeoutError:
+                        pass
+
+                out_f.write(("execution command return code: %s\n" % rc).encode("UTF-8"))
+
+            if local_temp_file is not None:
+                local_temp_file.close()
+
+            log.trace("subprocess return code: ", rc)
+            return rc, ProcessUsage(wall_time = time.monotonic() - start_time, max_rss = usage["max_rss"],
+                                    cpu_time = usage["cpu_time"])
+
+    @staticmethod
+    def _write_header(out_f, command:str, out_fn:str, environment:dict):
+        out_f.write("\n---- execution command ------ \n".encode("UTF-8"))
+        out_f.write(str(command).encode("UTF-8"))
+        out_f.write(("\n----- saving dump to file -----\n" + out_fn).encode("UTF-8"))
+        out_f.write("\n----- environment: -----\n".encode("UTF-8"))
+        out_f.write(str(environment).encode("UTF-8"))
+        out_f.write("\n-------------------\n".encode("UTF-8"))
+        out_f.flush()
+
+    @staticmethod
+    def _shell_command(command:str):
+        if sys.platform == "win32":
+            return [os.environ.get("COMSPEC", "cmd.exe"), "/c", command]
+        return ["/bin/sh", "-c", command]
+
+    @staticmethod
+    async def _async_pump_output(stream:asyncio.StreamReader, out_f, log:XcalLogger = None,
+                                 output_tail:OutputTail = None):
+        pending = b""
+        while True:
+            chunk = await stream.read(CommandLineUtility.READ_SIZE)
+            if not chunk:
+                break
+            out_f.write(chunk)
+            if output_tail is not None:
+                output_tail.append(chunk)
+            if log is not None:
+                lines = (pending + chunk).split(b"\n")
+                pending = lines.pop()
+                for line in lines:
+                    log.trace("[output]", line.decode("UTF-8", errors = "replace").strip())
+        if log is not None and pending:
+            log.trace("[output]", pending.decode("UTF-8", errors = "replace").strip())
+
+    @staticmethod
+    async def _async_sample_usage(pid:int, usage:dict):
+        """
+        Sample the memory and CPU time of a process and its descendants until cancelled
+        """
+        try:
+            root = psutil.Process(pid)
+        except psutil.NoSuchProcess:
+            return
+        while True:
+            rss = 0
+            cpu_time = 0.0
+            try:
+                for one_process in [root] + root.children(recursive = True):
+                    try:
+                        rss += one_process.memory_info().rss
+                        times = one_process.cpu_times()
+                        cpu_time += times.user + times.system + times.children_user + times.children_system
+                    except psutil.NoSuchProcess:
+                        pass
+            except psutil.NoSuchProcess:
+                return
+            usage["max_rss"] = max(usage["max_rss"], rss)
+            usage["cpu_time"] = max(usage["cpu_time"], cpu_time)
+            await asyncio.sleep(CommandLineUtility.USAGE_SAMPLE_INTERVAL)
+
+    @staticmethod
+    async def _async_wait_exit(process:asyncio.subprocess.Process):
+        """
+        Wait for the command itself to exit: process.wait() also waits for its output to be closed,
+        which descendants of the command may keep open
+        """
+        while process.returncode is None:
+            await asyncio.sleep(CommandLineUtility.EXIT_POLL_INTERVAL)
+        return process.returncode
+
+    @staticmethod
+    async def _async_kill_process_group(process:asyncio.subprocess.Process):
+        if sys.platform == "win32":
+            killer = await asyncio.create_subprocess_exec("taskkill", "/F", "/T", "/PID", str(process.pid),
+                                                          stdout = asyncio.subprocess.DEVNULL,
+                                                          stderr = asyncio.subprocess.DEVNULL)
+            await killer.wait()
+            await process.wait()
+            return
+
+        for one_signal in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.killpg(process.pid, one_signal)
+            except ProcessLookupError:
+                break
+            try:
+                await asyncio.wait_for(process.wait(), CommandLineUtility.KILL_GRACE_PERIOD)
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                break
+            except asyncio.TimeoutError:
+                continue
+            break
+        await process.wait()
+
+    @staticmethod
+    def _remaining(endtime):
         if endtime is None:
+            return None
+        return max(0.0, endtime - time.monotonic())
+
+    @staticmethod
+    def _pump_output(stream, out_f, log:XcalLogger = None, output_tail:OutputTail = None):
+        """
+        Copy the output of a subprocess to its log file in large binary reads, optionally echoing it line by line
+        """
+        pending = b""
+        while True:
+            chunk = stream.read1(CommandLineUtility.READ_SIZE)
+            if not chunk:
+                stream.close()
+                break
+            out_f.write(chunk)
+            if output_tail is not None:
+                output_tail.append(chunk)
+            if log is not None:
+                lines = (pending + chunk).split(b"\n")
+                pending = lines.pop()
+                for line in lines:
+                    log.trace("[output]", line.decode("UTF-8", errors = "replace").strip())
+        if log is not None and pending:
+            log.trace("[output]", pending.decode("UTF-8", errors = "replace").strip())
+
+    @staticmethod
+    def _process_group_kwargs():
+        if sys.platform == "win32":
+            return {"creationflags": subprocess.CREATE_NEW_PROCESS_GROUP}
+        return {"start_new_session": True}
+
+    @staticmethod
+    def kill_process_group(process:subprocess.Popen):
+        """
+        Terminate a process started by bash_execute together with all its descendants (e.g. a JVM under a shell),
+        killing them if they are still alive after a grace period.
+        """
+        if sys.platform == "win32":
+            subprocess.call(["taskkill", "/F", "/T", "/PID", str(process.pid)],
+                            stdout = subprocess.DEVNULL, stderr = subprocess.DEVNULL)
+            process.wait()
             return
-        if time.monotonic() > endtime:
-            raise XcalException("CommandLineUtility", "_check_timeout", "timeout: %s" % orig_timeout,
-                                TaskErrorNo.E_COMMON_TIMEOUT)
+
+        for one_signal in (signal.SIGTERM, signal.SIGKILL):
+            try:
+                os.killpg(process.pid, one_signal)
+            except ProcessLookupError:
+                break
+            try:
+                process.wait(timeout = CommandLineUtility.KILL_GRACE_PERIOD)
+                # Descendants may outlive the shell, make sure the whole group is gone
+                os.killpg(process.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                break
+            except subprocess.TimeoutExpired:
+                continue
+            break
+        process.wait()
@@ -3,13 +3,19 @@
 #
 
 
+import collections
+import gzip
+import io
 import logging
 import os
 import sys
 import tarfile
+import time
 import zipfile
 import shutil
 import json
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 from stat import S_IXUSR
 
 from common.CommonGlobals import TaskErrorNo
@@ -17,9 +23,98 @@ from common.XcalException import XcalException
 from common.XcalLogger import XcalLogger
 from common.FileUtility import FileUtility
 
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Compressions of CompressionUtility.open_tar_writer
+TAR_COMPRESSIONS = ("gz", "gz-parallel", "xz", "zstd", "none")
+# Level of both gzip compressions when none is given, so that they produce comparable archives
+GZIP_DEFAULT_LEVEL = 9
+
+
+class ParallelGzipWriter(object):
+    """
+    Write-only file object producing gzip data, compressed on a thread pool.
+    Every block_size bytes written become an independent gzip member; gzip readers
+    (gunzip, zcat, gzip/tarfile modules) read the concatenated members as one stream.
+    """
+
+    DEFAULT_BLOCK_SIZE = 1024 * 1024
+
+    def __init__(self, fileobj, level: int = GZIP_DEFAULT_LEVEL, block_size: int = DEFAULT_BLOCK_SIZE, workers: int = None):
+        """
+        :param fileobj: binary file object receiving the compressed data, not closed by close()
+        :param level: zlib compression level, 1-9
+        :param block_size: uncompressed size of each gzip member
+        :param workers: number of blocks compressed at the same time, defaults to the CPU count
+        """
+        self.fileobj = fileobj
+        self.level = level
+        self.block_size = block_size
+        self.workers = workers or os.cpu_count() or 1
+        self.pool = ThreadPoolExecutor(max_workers=self.workers)
+        # Compressed blocks, written in order as they complete
+        self.pending = collections.deque()
+        self.buffer = bytearray()
+        self.size = 0
+        self.members = 0
+        self.closed = False
+
+    def write(self, data):
+        self.buffer += data
+        self.size += len(data)
+        while len(self.buffer) >= self.block_size:
+            self._submit(bytes(self.buffer[:self.block_size]))
+            del self.buffer[:self.block_size]
+        return len(data)
+
+    def _submit(self, block: bytes):
+        self.pending.append(self.pool.submit(gzip.compress, block, self.level, mtime=0))
+        self.members += 1
+        # Bound the memory held by blocks waiting to be written
+        while len(self.pending) > 2 * self.workers:
+            self.fileobj.write(self.pending.popleft().result())
+
+    def tell(self):
+        """
+        :return: number of uncompressed bytes written
+        """
+        return self.size
+
+    def flush(self):
+        pass
+
+    def close(self):
+        """
+        Compress the last partial block and write all remaining members
+        """
+        if self.closed:
+            return
+        if len(self.buffer) > 0 or self.members == 0:
+            self._submit(bytes(self.buffer))
+            self.buffer = bytearray()
+        try:
+            while self.pending:
+                self.fileobj.write(self.pending.popleft().result())
+        finally:
+            self.pool.shutdown()
+            self.closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
 
 class CompressionUtility:
     ZIP_UNIX_SYSTEM = 3
+    # Timestamp of all entries written by add_dirs_to_zip_file, the earliest a zip file can hold
+    ZIP_FIXED_DATE_TIME = (1980, 1, 1, 0, 0, 0)
+    # Larger files are not read ahead in memory by add_dirs_to_zip_file
+    ZIP_READ_AHEAD_MAX = 16 * 1024 * 1024
 
     def __init__(self):
         pass
@@ -70,6 +165,93 @@ class CompressionUtility:
                                     TaskErrorNo.E_COMPRESS_FAIL)
         pass
 
+    @staticmethod
+    @contextmanager
+    def open_tar_writer(tarball_fn: str, compression: str = "gz", level: int = None, workers: int = None):
+        """
+        Open a tar archive for writing with one of TAR_COMPRESSIONS
+        :param tarball_fn: the output tar archive path
+        :param compression: gz, gz-parallel (multi-threaded gzip), xz, zstd (needs the zstandard package) or none
+        :param level: compression level, None for the default of the compression
+        :param workers: compression threads of gz-parallel and zstd, defaults to the CPU count
+        :return: context manager of the tarfile.TarFile
+        """
+        if compression == "gz":
+            with tarfile.open(tarball_fn, "w:gz", compresslevel=GZIP_DEFAULT_LEVEL if level is None else level) as tf:
+                yield tf
+        elif compression == "xz":
+            with tarfile.open(tarball_fn, "w:xz", preset=level) as tf:
+                yield tf
+        elif compression == "none":
+            with tarfile.open(tarball_fn, "w") as tf:
+                yield tf
+        elif compression == "gz-parallel":
+            with open(tarball_fn, "wb") as f, ParallelGzipWriter(f, GZIP_DEFAULT_LEVEL if level is None else level,
+                                                                 workers=workers) as gz_f:
+                with tarfile.open(fileobj=gz_f, mode="w|") as tf:
+                    yield tf
+        elif compression == "zstd":
+            if zstandard is None:
+                raise XcalException("CompressionUtility", "open_tar_writer",
+                                    "zstd compression needs the zstandard package",
+                                    TaskErrorNo.E_SYS_DEPENDENCY_NOT_EXIST)
+            compressor = zstandard.ZstdCompressor(level=3 if level is None else level,
+                                                  threads=workers or os.cpu_count() or 1)
+            with open(tarball_fn, "wb") as f, compressor.stream_writer(f) as zstd_f:
+                with tarfile.open(fileobj=zstd_f, mode="w|") as tf:
+                    yield tf
+        else:
+            raise XcalException("CompressionUtility", "open_tar_writer",
+                                "unknown compression %s, expected one of %s" % (compression,
+                                                                                ", ".join(TAR_COMPRESSIONS)),
+                                TaskErrorNo.E_CONFIG_PARM_ERROR)
+
+    @staticmethod
+    def add_fileobj_to_tar(tf: tarfile.TarFile, arcname: str, fileobj, size: int):
+        """
+        Add a regular file member read from fileobj, without a file on disk
+        :param tf: the tar archive opened for writing
+        :param arcname: name of the member
+        :param fileobj: binary file object positioned at the member data
+        :param size: number of bytes of the member
+        """
+        tar_info = tarfile.TarInfo(arcname)
+        tar_info.size = size
+        tar_info.mtime = int(time.time())
+        tf.addfile(tar_info, fileobj)
+
+    @staticmethod
+    def add_bytes_to_tar(tf: tarfile.TarFile, arcname: str, data: bytes):
+        """
+        Add a regular file member holding data, without a file on disk
+        """
+        CompressionUtility.add_fileobj_to_tar(tf, arcname, io.BytesIO(data), len(data))
+
+    @staticmethod
+    def add_hardlink_to_tar(tf: tarfile.TarFile, file_path: str, arcname: str, target_arcname: str):
+        """
+        Add file_path as a hard link member to target_arcname, a member with the same content added before,
+        so that its data is not stored twice
+        """
+        tar_info = tf.gettarinfo(file_path, arcname)
+        tar_info.type = tarfile.LNKTYPE
+        tar_info.linkname = target_arcname
+        tar_info.size = 0
+        tf.addfile(tar_info)
+
+    @staticmethod
+    def gzip_file(file_path: str):
+        """
+        Compress a file to file_path.gz, removing the original
+        :param file_path: the file to compress
+        :return: (str) path of the compressed file
+        """
+        gz_path = file_path + ".gz"
+        with open(file_path, "rb") as src_f, gzip.open(gz_path, "wb") as gz_f:
+            shutil.copyfileobj(src_f, gz_f)
+        os.remove(file_path)
+        return gz_path
+
     @staticmethod
     def extract_file(logger: XcalLogger, fname: str, dest_dir: str, remove: bool):
         """
@@ -193,9 +375,73 @@ class CompressionUtility:
                     absolute_path = os.path.join(root, file_name)
                     relative_path = absolute_path.replace(real_root + os.sep, '')
                     zip_file.write(absolute_path, relative_path)
-        except IOError or OSError or zipfile.BadZipFile as e:
+        except (IOError, OSError, zipfile.BadZipFile) as e:
             logging.exception(e)
             raise XcalException("CompressionUtility", "add_dir_to_zip_file", "cannot add the directory to the zip file",
                                 err_code=TaskErrorNo.E_UTIL_ZIP_COMPRESS)
-        finally:
-            zip_file.close()
+
+    @staticmethod
+    def _read_zip_entry(file_path: str):
+        if os.path.getsize(file_path) > CompressionUtility.ZIP_READ_AHEAD_MAX:
+            # Copied by the writer instead of held in memory
+            return None
+        with open(file_path, "rb") as f:
+            return f.read()
+
+    @staticmethod
+    def add_dirs_to_zip_file(paths: list, zip_file: zipfile.ZipFile, workers: int = None):
+        """
+        Zip the contents of several folders into the root of one archive, such as the
+        class-file directories of a module into one jar. The archive is byte-identical
+        for the same contents: entries are sorted, with fixed timestamps and permissions.
+        When several folders hold the same entry, the one in the first folder is kept,
+        as on a class path. Files are read ahead on a thread pool.
+        :param paths: the folders, in class path order
+        :param zip_file: zipfile handle, left open
+        :param workers: number of files read at the same time, defaults to the CPU count
+        """
+        entries = {}
+        try:
+            for one_path in paths:
+                real_root = os.path.abspath(one_path)
+                for root, folders, files in os.walk(real_root):
+                    relative_root = os.path.relpath(root, real_root).replace(os.sep, "/")
+                    prefix = "" if relative_root == "." else relative_root + "/"
+                    for folder_name in folders:
+                        entries.setdefault(prefix + folder_name + "/", None)
+                    for file_name in files:
+                        entries.setdefault(prefix + file_name, os.path.join(root, file_name))
+
+            names = sorted(entries)
+            workers = workers or os.cpu_count() or 1
+            with ThreadPoolExecutor(max_workers=workers) as pool:
+                pending = collections.deque()
+                next_index = 0
+                for one_name in names:
+                    # Keep a bounded window of files read ahead of the writer
+                    while next_index < len(names) and len(pending) < 4 * workers:
+                        file_path = entries[names[next_index]]
+                        pending.append(None if file_path is None else
+                                       pool.submit(CompressionUtility._read_zip_entry, file_path))
+                        next_index += 1
+                    read_future = pending.popleft()
+
+                    zip_info = zipfile.ZipInfo(one_name, date_time=CompressionUtility.ZIP_FIXED_DATE_TIME)
+                    zip_info.compress_type = zip_file.compression
+                    if read_future is None:
+                        zip_info.external_attr = (0o40755 << 16) | 0x10
+                        zip_file.writestr(zip_info, b"")
+                        continue
+                    zip_info.external_attr = 0o100644 << 16
+                    data = read_future.result()
+                    if data is not None:
+                        zip_file.writestr(zip_info, data)
+                    else:
+                        zip_info.file_size = os.path.getsize(entries[one_name])
+                        with open(entries[one_name], "rb") as src_f, zip_file.open(zip_info, "w") as dest_f:
+                            shutil.copyfileobj(src_f, dest_f, 1024 * 1024)
+        except (IOError, OSError, zipfile.BadZipFile) as e:
+            logging.exception(e)
+            raise XcalException("CompressionUtility", "add_dirs_to_zip_file",
+                                "cannot add the directories to the zip file",
+                                err_code=TaskErrorNo.E_UTIL_ZIP_COMPRESS)
@@ -4,6 +4,9 @@
 
 
 import os
+import shutil
+import sys
+import threading
 
 from common.CommonGlobals import TaskErrorNo
 from common.XcalException import XcalException
@@ -50,4 +53,39 @@ class FileUtility(object):
         if not os.access(dirname, os.W_OK | os.R_OK):
             raise XcalException("FileUtility", "check_dir_exist_readable", "Directory %s is not readable/writable" % dirname,
                                 TaskErrorNo.E_COMMON_FOLDER_PERMISSION)
-        pass
\ No newline at end of file
+        pass
+
+    @staticmethod
+    def link_or_copy(src: str, dest: str):
+        """
+        Materialize src at dest without copying data when possible:
+        hardlink first, then a reflink (copy-on-write clone, Linux only), then a plain copy.
+        An existing dest is replaced.
+        :return: (str) "link", "reflink" or "copy"
+        """
+        dest_dir = os.path.dirname(os.path.abspath(dest))
+        tmp_dest = os.path.join(dest_dir, ".%s.%d.%d.tmp" % (os.path.basename(dest), os.getpid(),
+                                                              threading.get_ident()))
+        if os.path.exists(tmp_dest):
+            os.remove(tmp_dest)
+        try:
+            os.link(src, tmp_dest)
+            method = "link"
+        except OSError:
+            method = FileUtility._reflink_or_copy(src, tmp_dest)
+        os.replace(tmp_dest, dest)
+        return method
+
+    @staticmethod
+    def _reflink_or_copy(src: str, dest: str):
+        if sys.platform.startswith("linux"):
+            import fcntl
+            ficlone = 0x40049409
+            with open(src, "rb") as src_f, open(dest, "wb") as dest_f:
+                try:
+                    fcntl.ioctl(dest_f.fileno(), ficlone, src_f.fileno())
+                    return "reflink"
+                except OSError:
+                    pass
+        shutil.copyfile(src, dest)
+        return "copy"
@@ -0,0 +1,97 @@
+#
+#  Copyright (C) 2019-2020  XC Software (Shenzhen) Ltd.
+#
+
+
+import os
+
+from common.HashUtility import HashUtility
+from common.SQLiteWriteBackStore import SQLiteWriteBackStore
+from common.XcalLogger import XcalLogger
+
+
+class HashCache(SQLiteWriteBackStore):
+    """
+    Persistent cache of file digests, keyed by (device, inode, size, mtime_ns),
+    so that unchanged files (e.g. jars in the local repository) are not hashed again by later runs.
+    """
+
+    DEFAULT_CACHE_FILE = os.path.join("~", ".cache", "xvsa-jfe", "hash-cache.sqlite")
+    # The oldest digests are dropped beyond this number of rows
+    MAX_ENTRIES = 1000000
+
+    def __init__(self, cache_file: str, logger: XcalLogger):
+        """
+        :param cache_file: SQLite database of the cache, created if missing
+        :param logger: XcalLogger of parent
+        """
+        super(HashCache, self).__init__(cache_file, logger, "hash-cache",
+                                        ["CREATE TABLE IF NOT EXISTS digests (dev INTEGER, inode INTEGER, "
+                                         "size INTEGER, mtime_ns INTEGER, algorithm TEXT, digest TEXT, "
+                                         "PRIMARY KEY (dev, inode, size, mtime_ns, algorithm))"],
+                                        "hashing every file")
+        self.hits = 0
+
+    @staticmethod
+    def _file_key(stat: os.stat_result):
+        return stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+    def _lookup(self, file_key: tuple, algorithm: str):
+        with self.lock:
+            digest = self.updated.get(file_key + (algorithm,))
+            if digest is None:
+                row = self.query_one("SELECT digest FROM digests WHERE dev = ? AND inode = ? AND size = ? AND "
+                                     "mtime_ns = ? AND algorithm = ?", file_key + (algorithm,))
+                digest = None if row is None else row[0]
+            if digest is not None:
+                self.hits += 1
+            return digest
+
+    def _store(self, stat: os.stat_result, algorithm: str, digest: str):
+        if not SQLiteWriteBackStore.is_racy(stat):
+            with self.lock:
+                self.updated[HashCache._file_key(stat) + (algorithm,)] = digest
+
+    def get_digest(self, filename: str, algorithm: str = "sha256"):
+        """
+        :return: digest of filename in hex, from the cache if the file did not change
+        """
+        return self.get_digests([filename], algorithm)[filename]
+
+    def get_digests(self, filenames, algorithm: str = "sha256", workers: int = None):
+        """
+        Digests of many files, hashing the ones not in the cache on a thread pool
+        :return: {filename: digest in hex}
+        """
+        digests = {}
+        missing = {}
+        for one_file in filenames:
+            stat = os.stat(one_file)
+            digest = self._lookup(HashCache._file_key(stat), algorithm)
+            if digest is not None:
+                digests[one_file] = digest
+            else:
+                missing[one_file] = stat
+        if len(missing) > 1:
+            calculated = HashUtility.get_files_digests(missing, (algorithm,), workers)
+        else:
+            calculated = dict((one_file, HashUtility.get_file_digests(one_file, (algorithm,))) for one_file in missing)
+        for one_file, one_digests in calculated.items():
+            digests[one_file] = one_digests[algorithm]
+            self._store(missing[one_file], algorithm, one_digests[algorithm])
+        return digests
+
+    def write_back(self, updated: dict):
+        """
+        Write the digests calculated by this process, and trim the cache to MAX_ENTRIES
+        """
+        self.db.executemany("INSERT OR REPLACE INTO digests (dev, inode, size, mtime_ns, algorithm, digest) "
+                            "VALUES (?, ?, ?, ?, ?, ?)",
+                            [one_key + (digest,) for one_key, digest in updated.items()])
+        excess = self.db.execute("SELECT COUNT(*) FROM digests").fetchone()[0] - HashCache.MAX_ENTRIES
+        if excess > 0:
+            self.db.execute("DELETE FROM digests WHERE rowid IN "
+                            "(SELECT rowid FROM digests ORDER BY rowid LIMIT ?)", (excess,))
+
+    def summary(self, updated: dict):
+        return "%d digests from cache, %d stored" % (self.hits, len(updated))
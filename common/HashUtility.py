@@ -7,6 +7,7 @@ import hashlib
 import logging
 import os
 import zlib
+from concurrent.futures import ThreadPoolExecutor
 
 
 class CRC32(object):
@@ -47,8 +48,55 @@ class CRC32(object):
         copy._digest = self._digest
         return copy
 
+    def hexdigest(self):
+        return "%08x" % self._digest
+
 
 class HashUtility(object):
+    # Read size of the streaming digests, large enough to keep the per-read overhead negligible
+    HASH_BUFFER_SIZE = 1024 * 1024
+
+    @staticmethod
+    def _new_hasher(algorithm: str):
+        if algorithm == CRC32.name:
+            return CRC32()
+        return hashlib.new(algorithm)
+
+    @staticmethod
+    def get_file_digests(filename, algorithms=("sha256",)):
+        """
+        Calculate several digests of a file in a single pass over it, reading into one reused buffer
+
+        :param filename: file path, which should be 'rb' readable
+        :param algorithms: names of hashlib algorithms, or crc32
+        :return: {algorithm: digest in hex}
+        """
+        hashers = [(algorithm, HashUtility._new_hasher(algorithm)) for algorithm in algorithms]
+        buffer = bytearray(HashUtility.HASH_BUFFER_SIZE)
+        view = memoryview(buffer)
+        with open(filename, mode="rb", buffering=0) as fp:
+            while True:
+                size = fp.readinto(buffer)
+                if not size:
+                    break
+                for _, one_hasher in hashers:
+                    one_hasher.update(view[:size])
+        return dict((algorithm, one_hasher.hexdigest()) for algorithm, one_hasher in hashers)
+
+    @staticmethod
+    def get_files_digests(filenames, algorithms=("sha256",), workers: int = None):
+        """
+        Calculate the digests of many files on a thread pool, hashlib releasing the GIL while hashing
+
+        :param filenames: file paths
+        :param algorithms: names of hashlib algorithms, or crc32
+        :param workers: number of files hashed at the same time, defaults to the CPU count
+        :return: {filename: {algorithm: digest in hex}}
+        """
+        filenames = list(filenames)
+        with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as pool:
+            all_digests = pool.map(lambda one_file: HashUtility.get_file_digests(one_file, algorithms), filenames)
+            return dict(zip(filenames, all_digests))
 
     @staticmethod
     def get_crc32_checksum(filename):
@@ -58,14 +106,7 @@ class HashUtility(object):
         :param filename: Name of the file to calculate the hash for.
         :returns: Digest of the file, in hex.
         """
-        crc32 = CRC32()
-        chunk_size=4096
-        with open(filename, mode="rb", buffering=0) as fp:
-            buffer = fp.read(chunk_size)
-            while len(buffer) > 0:
-                crc32.update(buffer)
-                buffer = fp.read(chunk_size)
-        return str(crc32._digest)
+        return str(int(HashUtility.get_file_digests(filename, (CRC32.name,))[CRC32.name], 16))
         #return hex(crc32._digest).upper()[2:]  #return hex value
 
     @staticmethod
@@ -87,11 +128,7 @@ class HashUtility(object):
             logging.error("[_get_checksum] %s cannot be read", filename)
             return -1
 
-        hash_md5 = hashlib.md5()
-        with open(filename, "rb") as f:
-            for chunk in iter(lambda: f.read(4096), b""):
-                hash_md5.update(chunk)
-        return hash_md5.hexdigest()
+        return HashUtility.get_file_digests(filename, ("md5",))["md5"]
 
     @staticmethod
     def get_sha256_hash(filename):
@@ -100,9 +137,7 @@ class HashUtility(object):
         :param filename:
         :return:
         """
-        with open(filename, "rb") as f:
-            sha = hashlib.sha256(f.read()).hexdigest()
-        return sha
+        return HashUtility.get_file_digests(filename, ("sha256",))["sha256"]
 
     @staticmethod
     def get_sha1_hash(filename):
@@ -111,6 +146,4 @@ class HashUtility(object):
         :param filename:
         :return:
         """
-        with open(filename, "rb") as f:
-            sha = hashlib.sha1(f.read()).hexdigest()
-        return sha
+        return HashUtility.get_file_digests(filename, ("sha1",))["sha1"]
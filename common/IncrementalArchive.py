@@ -0,0 +1,183 @@
+#
+#  Copyright (C) 2019-2020  XC Software (Shenzhen) Ltd.
+#
+
+
+import collections
+import hashlib
+import json
+import os
+import tarfile
+import tempfile
+
+from common.CompressionUtility import CompressionUtility
+from common.HashUtility import HashUtility
+
+
+class IncrementalTarWriter(object):
+    """
+    Add members to a tar archive while recording a manifest of their digests,
+    compared against the manifest of the previous archive:
+    - unchanged source files are not hashed again (same path, size and mtime),
+    - changed and new members are also written to an optional delta archive,
+      closed by a delta-manifest.json listing changed and removed members.
+    Without a previous manifest it only passes the members through to the archive.
+    """
+
+    MANIFEST_SUFFIX = ".manifest.json"
+    DELTA_MANIFEST = "delta-manifest.json"
+
+    def __init__(self, tf: tarfile.TarFile, previous_manifest: dict = None, delta_tf: tarfile.TarFile = None,
+                 hash_file=HashUtility.get_sha256_hash):
+        """
+        :param tf: the archive opened for writing
+        :param previous_manifest: {member name: entry} of the previous archive, None not to track the members
+        :param delta_tf: archive receiving the changed members, None for no delta
+        :param hash_file: function returning the sha256 of a file path, e.g. through a HashCache
+        """
+        self.tf = tf
+        self.hash_file = hash_file
+        self.tracking = previous_manifest is not None
+        self.previous = previous_manifest or {}
+        self.delta_tf = delta_tf
+        self.manifest = collections.OrderedDict()
+        self.changed = []
+
+    @staticmethod
+    def load_manifest(manifest_file: str):
+        """
+        :return: {member name: entry} of a previous archive, empty if there is none
+        """
+        if not os.path.isfile(manifest_file):
+            return {}
+        try:
+            with open(manifest_file, "r") as f:
+                return json.load(f)["members"]
+        except (ValueError, KeyError):
+            return {}
+
+    def save_manifest(self, manifest_file: str):
+        fd, tmp_path = tempfile.mkstemp(prefix=".manifest-", dir=os.path.dirname(os.path.abspath(manifest_file)))
+        with os.fdopen(fd, "w") as f:
+            json.dump({"members": self.manifest}, f)
+        os.replace(tmp_path, manifest_file)
+
+    @staticmethod
+    def dirs_fingerprint(paths: list):
+        """
+        Digest of the names, sizes and mtimes of all files under paths, without reading them
+        """
+        sha = hashlib.sha256()
+        for index, one_path in enumerate(paths):
+            for root, folders, files in os.walk(one_path):
+                folders.sort()
+                for file_name in sorted(files):
+                    file_path = os.path.join(root, file_name)
+                    stat = os.stat(file_path)
+                    sha.update(("%d:%s:%d:%d\0" % (index, os.path.relpath(file_path, one_path), stat.st_size,
+                                                   stat.st_mtime_ns)).encode("UTF-8"))
+        return "dir:" + sha.hexdigest()
+
+    def file_digest(self, file_path: str, arcname: str):
+        """
+        :return: sha256 of a file (fingerprint of a directory) added as arcname,
+                 taken from the previous manifest if the file did not change
+        """
+        if os.path.isdir(file_path):
+            return IncrementalTarWriter.dirs_fingerprint([file_path])
+        stat = os.stat(file_path)
+        entry = self.previous.get(arcname)
+        if (entry is not None and entry.get("source") == os.path.abspath(file_path) and
+                entry.get("size") == stat.st_size and entry.get("mtime_ns") == stat.st_mtime_ns):
+            return entry["digest"]
+        return self.hash_file(file_path)
+
+    def _record(self, arcname: str, entry: dict):
+        if not self.tracking:
+            return False
+        self.manifest[arcname] = entry
+        previous_entry = self.previous.get(arcname)
+        changed = previous_entry is None or previous_entry.get("digest") != entry["digest"]
+        if changed:
+            self.changed.append(arcname)
+        return changed and self.delta_tf is not None
+
+    def add_file(self, file_path: str, arcname: str, digest: str = None):
+        """
+        Add a file or directory from disk
+        :param digest: result of file_digest, if already known
+        """
+        self.tf.add(file_path, arcname=arcname)
+        if not self.tracking:
+            return
+        if digest is None:
+            digest = self.file_digest(file_path, arcname)
+        stat = os.stat(file_path)
+        if self._record(arcname, {"digest": digest, "source": os.path.abspath(file_path), "size": stat.st_size,
+                                  "mtime_ns": stat.st_mtime_ns}):
+            self.delta_tf.add(file_path, arcname=arcname)
+
+    def add_hardlink(self, file_path: str, arcname: str, target_arcname: str):
+        """
+        Add file_path as a hard link to target_arcname, added before with the same content
+        """
+        CompressionUtility.add_hardlink_to_tar(self.tf, file_path, arcname, target_arcname)
+        if not self.tracking:
+            return
+        entry = dict(self.manifest[target_arcname])
+        entry["link"] = target_arcname
+        if self._record(arcname, entry):
+            if target_arcname in self.changed:
+                CompressionUtility.add_hardlink_to_tar(self.delta_tf, file_path, arcname, target_arcname)
+            else:
+                # The target is not part of the delta
+                self.delta_tf.add(file_path, arcname=arcname)
+
+    def add_bytes(self, arcname: str, data: bytes):
+        CompressionUtility.add_bytes_to_tar(self.tf, arcname, data)
+        if self._record(arcname, {"digest": hashlib.sha256(data).hexdigest(), "size": len(data)}):
+            CompressionUtility.add_bytes_to_tar(self.delta_tf, arcname, data)
+
+    def previous_digest(self, arcname: str, source: str):
+        """
+        :return: digest of member arcname in the previous archive if it was made from the same source, else None
+        """
+        entry = self.previous.get(arcname)
+        if entry is not None and entry.get("source") == source:
+            return entry["digest"]
+        return None
+
+    def add_fileobj(self, arcname: str, fileobj, size: int, digest: str = None, source: str = None):
+        """
+        Add a member read from a seekable fileobj, positioned at its start
+        :param digest: sha256 of the data, computed if None and the members are tracked
+        :param source: identity of what the data was made from, for previous_digest
+        """
+        start = fileobj.tell()
+        if self.tracking and digest is None:
+            sha = hashlib.sha256()
+            for chunk in iter(lambda: fileobj.read(1024 * 1024), b""):
+                sha.update(chunk)
+            digest = sha.hexdigest()
+            fileobj.seek(start)
+        CompressionUtility.add_fileobj_to_tar(self.tf, arcname, fileobj, size)
+        if self._record(arcname, {"digest": digest, "size": size, "source": source}):
+            fileobj.seek(start)
+            CompressionUtility.add_fileobj_to_tar(self.delta_tf, arcname, fileobj, size)
+
+    def removed(self):
+        """
+        :return: members of the previous archive not added to this one
+        """
+        return sorted(name for name in self.previous if name not in self.manifest)
+
+    def finish(self):
+        """
+        Close the delta archive content with the delta manifest, for the consumer to merge
+        the delta into the extracted previous archive
+        """
+        if self.delta_tf is None:
+            return
+        delta_manifest = {"changed": self.changed, "removed": self.removed(), "members": self.manifest}
+        CompressionUtility.add_bytes_to_tar(self.delta_tf, IncrementalTarWriter.DELTA_MANIFEST,
+                                            json.dumps(delta_manifest).encode("UTF-8"))
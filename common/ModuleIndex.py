@@ -0,0 +1,95 @@
+#
+#  Copyright (C) 2019-2020  XC Software (Shenzhen) Ltd.
+#
+
+
+import json
+import os
+import sqlite3
+import time
+
+from common.SQLiteWriteBackStore import SQLiteWriteBackStore
+from common.XcalLogger import XcalLogger
+
+
+class ModuleIndex(SQLiteWriteBackStore):
+    """
+    Persistent index of the .lib.list/.dir.list files generated by the plugin,
+    recording path, mtime, size and parsed entries of each list file.
+    A list file is only parsed again when its size or mtime changed.
+    The index may be shared by all checkouts of a host: rows are looked up per path,
+    and rows not used for MAX_AGE_SECONDS are dropped.
+    """
+
+    DEFAULT_INDEX_FILE = os.path.join("~", ".cache", "xvsa-jfe", "module-index.sqlite")
+    MAX_AGE_SECONDS = 30 * 24 * 3600
+
+    def __init__(self, index_file: str, logger: XcalLogger):
+        """
+        :param index_file: SQLite database of the index, created if missing
+        :param logger: XcalLogger of parent
+        """
+        super(ModuleIndex, self).__init__(index_file, logger, "module-index",
+                                          ["CREATE TABLE IF NOT EXISTS list_files (path TEXT PRIMARY KEY, "
+                                           "mtime_ns INTEGER, size INTEGER, entries TEXT, used_at REAL DEFAULT 0)"],
+                                          "reading lists directly")
+        self.used = set()
+        self.parsed = 0
+        self.dropped = 0
+        if self.db is not None:
+            try:
+                columns = [row[1] for row in self.db.execute("PRAGMA table_info(list_files)")]
+                if "used_at" not in columns:
+                    # Index written before rows were aged
+                    self.db.execute("ALTER TABLE list_files ADD COLUMN used_at REAL DEFAULT 0")
+            except sqlite3.Error as err:
+                self.logger.warn(self.service, "Cannot upgrade %s, reading lists directly: %s" % (self.db_file, err))
+                self.db = None
+
+    @staticmethod
+    def parse_list(fn: str):
+        """
+        Read a list file into an array of its lines, without line endings
+        """
+        with open(fn, "r") as f:
+            lines = f.read().split("\n")
+        if lines[-1] == "":
+            lines.pop()
+        return lines
+
+    def read_list(self, fn: str):
+        """
+        :return: the entries of list file fn, from the index if fn did not change since it was indexed
+        """
+        path = os.path.abspath(fn)
+        stat = os.stat(path)
+        with self.lock:
+            self.used.add(path)
+            cached = self.updated.get(path)
+            if cached is None:
+                cached = self.query_one("SELECT mtime_ns, size, entries FROM list_files WHERE path = ?", (path,))
+        if cached is not None and cached[0] == stat.st_mtime_ns and cached[1] == stat.st_size:
+            return json.loads(cached[2])
+
+        lines = ModuleIndex.parse_list(path)
+        if not SQLiteWriteBackStore.is_racy(stat):
+            with self.lock:
+                self.updated[path] = (stat.st_mtime_ns, stat.st_size, json.dumps(lines))
+                self.parsed += 1
+        return lines
+
+    def write_back(self, updated: dict):
+        """
+        Write the changed entries, mark the used ones, and drop the entries not used for MAX_AGE_SECONDS
+        """
+        now = time.time()
+        self.db.executemany("INSERT OR REPLACE INTO list_files (path, mtime_ns, size, entries, used_at) "
+                            "VALUES (?, ?, ?, ?, ?)",
+                            [(path,) + one_entry + (now,) for path, one_entry in updated.items()])
+        self.db.executemany("UPDATE list_files SET used_at = ? WHERE path = ?",
+                            [(now, path) for path in self.used if path not in updated])
+        self.dropped = self.db.execute("DELETE FROM list_files WHERE used_at < ?",
+                                       (now - ModuleIndex.MAX_AGE_SECONDS,)).rowcount
+
+    def summary(self, updated: dict):
+        return "%d list files used, %d parsed, %d dropped" % (len(self.used), self.parsed, self.dropped)
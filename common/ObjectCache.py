@@ -0,0 +1,239 @@
+#
+#  Copyright (C) 2019-2020  XC Software (Shenzhen) Ltd.
+#
+
+
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from common.FileUtility import FileUtility
+from common.XcalLogger import XcalLogger
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+
+class ObjectCache(object):
+    """
+    Content-addressed store of generated objects (e.g. library vtable .o files),
+    which may be shared by all checkouts and jobs on a host.
+    Entries are keyed by a digest of everything that determines the object,
+    published atomically, and materialized into output directories as hardlinks
+    (or reflinks/copies when linking is not possible).
+    The store is bounded by max_size, evicting the least recently used entries.
+    The last use of an entry is the mtime of its sidecar file, as the entry itself shares
+    its inode with the materialized objects, whose mtimes must not change on a cache hit.
+    """
+
+    OBJECT_SUFFIX = ".o"
+    USED_SUFFIX = ".used"
+    STATS_FILE = "stats.json"
+    LOCK_FILE = ".lock"
+    DEFAULT_CACHE_DIR = os.path.join("~", ".cache", "xvsa-jfe")
+
+    def __init__(self, cache_dir: str, logger: XcalLogger, max_size: int = None):
+        """
+        :param cache_dir: directory of the store, created if missing
+        :param logger: XcalLogger of parent
+        :param max_size: maximum total size of the entries in bytes, None for unbounded
+        """
+        self.cache_dir = os.path.abspath(os.path.expanduser(cache_dir))
+        self.logger = logger
+        self.max_size = max_size
+        # Counters of this process, merged into the persistent stats by close()
+        self.stats = {"hits": 0, "misses": 0, "bytes_saved": 0, "bytes_published": 0, "evicted": 0}
+        self.stats_lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(*parts):
+        """
+        Build a cache key from the parts determining the object, e.g. input hash, tool identity and flags
+        :return: (str) hex digest
+        """
+        sha = hashlib.sha256()
+        for one_part in parts:
+            sha.update(str(one_part).encode("UTF-8"))
+            sha.update(b"\0")
+        return sha.hexdigest()
+
+    def entry_path(self, key: str):
+        return os.path.join(self.cache_dir, key[:2], key + ObjectCache.OBJECT_SUFFIX)
+
+    def lookup(self, key: str):
+        """
+        :return: path of the cached object, or None if it is not cached
+        """
+        path = self.entry_path(key)
+        if os.path.isfile(path):
+            return path
+        return None
+
+    def publish(self, key: str, src: str):
+        """
+        Store src under key. The entry only becomes visible once complete, so that
+        concurrent writers and readers never see a partial object.
+        :return: path of the cached object
+        """
+        path = self.entry_path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(prefix=".publish-", dir=os.path.dirname(path))
+        os.close(fd)
+        try:
+            FileUtility.link_or_copy(src, tmp_path)
+            os.replace(tmp_path, path)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        self._mark_used(path)
+        self._count(misses=1, bytes_published=os.path.getsize(path))
+        self.logger.info("cache-publish", "%s -> %s" % (src, path))
+        return path
+
+    def materialize(self, key: str, dest: str):
+        """
+        Place the cached object of key at dest
+        :return: True if the object was cached and placed, False otherwise
+        """
+        path = self.lookup(key)
+        if path is None:
+            return False
+        try:
+            if not (os.path.exists(dest) and os.path.samefile(path, dest)):
+                method = FileUtility.link_or_copy(path, dest)
+                self.logger.info("cache-hit", "%s -> %s (%s)" % (path, dest, method))
+            self._mark_used(path)
+            self._count(hits=1, bytes_saved=os.path.getsize(path))
+        except FileNotFoundError:
+            # Evicted by another process in the meantime
+            return False
+        return True
+
+    @staticmethod
+    def _mark_used(path: str):
+        """
+        Record the last use time of the entry at path, for the LRU eviction
+        """
+        with open(path + ObjectCache.USED_SUFFIX, "a"):
+            pass
+        os.utime(path + ObjectCache.USED_SUFFIX)
+
+    def _count(self, **deltas):
+        with self.stats_lock:
+            for name, value in deltas.items():
+                self.stats[name] += value
+
+    @contextmanager
+    def _locked(self):
+        """
+        Serialize stats updates and eviction among all processes sharing the store
+        """
+        with open(os.path.join(self.cache_dir, ObjectCache.LOCK_FILE), "a") as lock_f:
+            if fcntl is not None:
+                fcntl.flock(lock_f.fileno(), fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(lock_f.fileno(), fcntl.LOCK_UN)
+
+    def list_entries(self):
+        """
+        :return: list of (last use time, size, path) of all entries
+        """
+        entries = []
+        for one_dir in os.scandir(self.cache_dir):
+            if not one_dir.is_dir():
+                continue
+            for one_entry in os.scandir(one_dir.path):
+                if not one_entry.name.endswith(ObjectCache.OBJECT_SUFFIX):
+                    continue
+                try:
+                    stat = one_entry.stat()
+                except FileNotFoundError:
+                    continue
+                try:
+                    last_used = os.stat(one_entry.path + ObjectCache.USED_SUFFIX).st_mtime
+                except FileNotFoundError:
+                    # Entry published before sidecars were used
+                    last_used = stat.st_mtime
+                entries.append((last_used, stat.st_size, one_entry.path))
+        return entries
+
+    def evict(self):
+        """
+        Remove the least recently used entries until the store fits into max_size.
+        Objects already materialized as hardlinks stay valid.
+        :return: (int) number of entries removed
+        """
+        if self.max_size is None:
+            return 0
+        removed = 0
+        with self._locked():
+            entries = self.list_entries()
+            total_size = sum(one_entry[1] for one_entry in entries)
+            for last_used, size, path in sorted(entries):
+                if total_size <= self.max_size:
+                    break
+                for one_path in (path, path + ObjectCache.USED_SUFFIX):
+                    try:
+                        os.remove(one_path)
+                    except FileNotFoundError:
+                        pass
+                total_size -= size
+                removed += 1
+        if removed > 0:
+            self.logger.info("cache-evict", "Evicted %d entries from %s" % (removed, self.cache_dir))
+        self._count(evicted=removed)
+        return removed
+
+    def read_stats(self):
+        """
+        :return: dict of the persistent stats of the store
+        """
+        stats_file = os.path.join(self.cache_dir, ObjectCache.STATS_FILE)
+        stats = dict.fromkeys(self.stats.keys(), 0)
+        if os.path.isfile(stats_file):
+            with open(stats_file, "r") as f:
+                stats.update(json.load(f))
+        return stats
+
+    def close(self):
+        """
+        Enforce max_size and merge the counters of this process into the persistent stats
+        """
+        self.evict()
+        with self.stats_lock:
+            deltas = self.stats
+            self.stats = dict.fromkeys(deltas.keys(), 0)
+        with self._locked():
+            stats = self.read_stats()
+            for name, value in deltas.items():
+                stats[name] += value
+            fd, tmp_path = tempfile.mkstemp(prefix=".stats-", dir=self.cache_dir)
+            with os.fdopen(fd, "w") as f:
+                json.dump(stats, f)
+            os.replace(tmp_path, os.path.join(self.cache_dir, ObjectCache.STATS_FILE))
+
+    def report(self):
+        """
+        :return: (str) human readable summary of the store and its persistent stats
+        """
+        stats = self.read_stats()
+        entries = self.list_entries()
+        lookups = stats["hits"] + stats["misses"]
+        hit_rate = 100.0 * stats["hits"] / lookups if lookups > 0 else 0.0
+        lines = ["cache directory : %s" % self.cache_dir,
+                 "entries         : %d" % len(entries),
+                 "size            : %.1f MB" % (sum(one_entry[1] for one_entry in entries) / (1024 * 1024)),
+                 "hits / misses   : %d / %d" % (stats["hits"], stats["misses"]),
+                 "hit rate        : %.1f %%" % hit_rate,
+                 "bytes saved     : %.1f MB" % (stats["bytes_saved"] / (1024 * 1024)),
+                 "evicted         : %d" % stats["evicted"]]
+        return "\n".join(lines)
@@ -0,0 +1,89 @@
+#
+#  Copyright (C) 2019-2020  XC Software (Shenzhen) Ltd.
+#
+
+
+import os
+import sqlite3
+import threading
+import time
+
+from common.XcalLogger import XcalLogger
+
+
+class SQLiteWriteBackStore(object):
+    """
+    Base of the persistent stores keeping facts about files in SQLite across runs, e.g. ModuleIndex
+    and HashCache. Rows are looked up on demand; rows computed by this process are kept in memory
+    and written back in one transaction by close().
+    A store is a pure accelerator: if its file cannot be opened, every lookup misses.
+    """
+
+    # Files modified this recently may be rewritten within the same mtime tick, no row is kept for them
+    RACY_SECONDS = 2.0
+
+    def __init__(self, db_file: str, logger: XcalLogger, service: str, schema: list, fallback: str):
+        """
+        :param db_file: SQLite database of the store, created if missing
+        :param logger: XcalLogger of parent
+        :param service: name of the store in the log
+        :param schema: statements creating the tables if missing
+        :param fallback: what is done without the store, for the log
+        """
+        self.db_file = os.path.abspath(os.path.expanduser(db_file))
+        self.logger = logger
+        self.service = service
+        self.lock = threading.Lock()
+        self.db = None
+        # Rows computed by this process, written back by close()
+        self.updated = {}
+        try:
+            os.makedirs(os.path.dirname(self.db_file), exist_ok=True)
+            self.db = sqlite3.connect(self.db_file, timeout=30, check_same_thread=False)
+            for one_statement in schema:
+                self.db.execute(one_statement)
+        except (sqlite3.Error, OSError) as err:
+            self.logger.warn(service, "Cannot open %s, %s: %s" % (self.db_file, fallback, err))
+            self.db = None
+
+    @staticmethod
+    def is_racy(stat: os.stat_result):
+        return time.time() - stat.st_mtime <= SQLiteWriteBackStore.RACY_SECONDS
+
+    def query_one(self, sql: str, params: tuple):
+        """
+        :return: the first row of a query, None if there is none or the store is not open; the caller holds lock
+        """
+        if self.db is None:
+            return None
+        return self.db.execute(sql, params).fetchone()
+
+    def write_back(self, updated: dict):
+        """
+        Write the rows computed by this process, in the transaction of close()
+        """
+        raise NotImplementedError
+
+    def summary(self, updated: dict):
+        """
+        :return: (str) statistics of this process logged by close()
+        """
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Write the rows computed by this process back to the store
+        """
+        if self.db is None:
+            return
+        with self.lock:
+            updated = self.updated
+            self.updated = {}
+        try:
+            with self.db:
+                self.write_back(updated)
+        except sqlite3.Error as err:
+            self.logger.warn(self.service, "Cannot update %s: %s" % (self.db_file, err))
+        self.logger.info(self.service, self.summary(updated))
+        self.db.close()
+        self.db = None
@@ -0,0 +1,102 @@
+#
+#  Copyright (C) 2019-2020  XC Software (Shenzhen) Ltd.
+#
+
+
+import collections
+import threading
+import time
+
+import psutil
+
+MB = 1024 * 1024
+
+# One immutable reading of the host, replaced as a whole by the sampler thread
+SystemSnapshot = collections.namedtuple("SystemSnapshot", [
+    "timestamp",              # time.monotonic() of the latest sample
+    "cpu_percent",            # instantaneous CPU usage, 0-100, over the last interval
+    "cpu_percent_avg",        # CPU usage averaged over the window
+    "mem_total_mb",
+    "mem_available_mb",       # latest available memory
+    "mem_available_min_mb",   # lowest available memory over the window
+    "swap_used_percent",      # latest swap usage, 0-100
+    "load_avg",               # latest 1 minute load average
+    "swap_used_percent_max",  # highest swap usage over the window
+    "load_avg_max",           # highest 1 minute load average over the window
+])
+
+
+class SystemSampler(object):
+    """
+    Sample CPU, memory, swap and load average of the host on a background thread,
+    keeping rolling windows of the samples. snapshot() only returns the latest
+    reading, so it is cheap enough to be called on every scheduling decision.
+    """
+
+    def __init__(self, interval: float = 1.0, window: int = 30):
+        """
+        :param interval: seconds between two samples
+        :param window: number of samples kept for the averages
+        """
+        self.interval = interval
+        self.cpu_window = collections.deque(maxlen=window)
+        self.mem_window = collections.deque(maxlen=window)
+        self.swap_window = collections.deque(maxlen=window)
+        self.load_window = collections.deque(maxlen=window)
+        self.latest = None
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        """
+        Take a first sample synchronously, then keep sampling in a daemon thread
+        """
+        if self.thread is not None:
+            return self
+        psutil.cpu_percent(interval=None)
+        self.sample(psutil.cpu_percent(interval=0.1))
+        self.thread = threading.Thread(target=self._run, name="system-sampler", daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def _run(self):
+        while not self.stop_event.wait(self.interval):
+            # Percentage since the previous call, i.e. over the last interval
+            self.sample(psutil.cpu_percent(interval=None))
+
+    def sample(self, cpu_percent: float):
+        mem = psutil.virtual_memory()
+        swap = psutil.swap_memory()
+        load_avg = psutil.getloadavg()[0]
+        self.cpu_window.append(cpu_percent)
+        self.mem_window.append(mem.available / MB)
+        self.swap_window.append(swap.percent)
+        self.load_window.append(load_avg)
+        self.latest = SystemSnapshot(timestamp=time.monotonic(),
+                                     cpu_percent=cpu_percent,
+                                     cpu_percent_avg=sum(self.cpu_window) / len(self.cpu_window),
+                                     mem_total_mb=mem.total / MB,
+                                     mem_available_mb=mem.available / MB,
+                                     mem_available_min_mb=min(self.mem_window),
+                                     swap_used_percent=swap.percent,
+                                     load_avg=load_avg,
+                                     swap_used_percent_max=max(self.swap_window),
+                                     load_avg_max=max(self.load_window))
+
+    def snapshot(self):
+        """
+        :return: SystemSnapshot, the latest reading without any system call
+        """
+        return self.latest
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
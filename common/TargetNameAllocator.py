@@ -0,0 +1,46 @@
+#
+#  Copyright (C) 2019-2020  XC Software (Shenzhen) Ltd.
+#
+
+
+import hashlib
+import os
+
+
+class TargetNameAllocator(object):
+    """
+    Allocate unique target names (e.g. the <name>.dir entries of the preprocess archive)
+    from jar paths, class-file directories and module prefixes, in O(1) per name.
+    A name is the base name of its path; a colliding path gets a short hash of the path
+    appended, so its name does not depend on how many other paths collided before it,
+    with a per-name counter as the last resort.
+    """
+
+    HASH_LENGTH = 8
+
+    def __init__(self):
+        self.taken = set()
+        # Next counter to try for a name whose hashed form also collided
+        self.counters = {}
+        self.collisions = 0
+
+    @staticmethod
+    def base_name(path: str):
+        return os.path.basename(path.rstrip("/" + os.sep)).replace(".", "-").replace(" ", "")
+
+    def allocate(self, path: str):
+        """
+        :return: (str) a target name for path, not returned for any other call before
+        """
+        name = TargetNameAllocator.base_name(path)
+        if name in self.taken:
+            self.collisions += 1
+            name = "%s-%s" % (name, hashlib.sha1(path.encode("UTF-8")).hexdigest()[:TargetNameAllocator.HASH_LENGTH])
+            if name in self.taken:
+                counter = self.counters.get(name, 1)
+                while "%s-%d" % (name, counter) in self.taken:
+                    counter += 1
+                self.counters[name] = counter + 1
+                name = "%s-%d" % (name, counter)
+        self.taken.add(name)
+        return name
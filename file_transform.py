@@ -1,55 +1,289 @@
 #!/usr/bin/env python3
 import os, sys, argparse, re
+import glob
+import io
+import locale
+import mmap
+import multiprocessing
 
 all_args = None
 
-def transform_file(fn:str, outfp):
+# Compiled once per interpreter, shared by all files transformed in batch mode
+ztvstart = re.compile("\[[0-9]*\]: (_ZTV.*) \[.*\]")
+ztvend = re.compile(" ENDBLOCK")
+ztvnormal = re.compile(" SYMOFF: (_ZN.*) \[[0-9,]*\].*")
+classname = re.compile("\[[0-9]*\]: (_ZN.*class\$E.*) \[.*\]")
+
+# Lines the mmap engine looks at, any other line does not change the output.
+# Searched from the preceding newline, which lets the regex engine skip ahead to each newline.
+candidate_line = re.compile(rb"(?:\[[0-9]*\]: _Z|\x20SYMOFF: _ZN|\x20ENDBLOCK)[^\n]*")
+next_candidate_line = re.compile(rb"\n(" + candidate_line.pattern + rb")")
+symoff_index = re.compile(rb"[0-9,]*\]")
+
+# Start of the section of an ir_b2a dump holding the initialized objects, i.e. the vtables
+INITO_MARKER = b"INITOs:"
+
+INITO_SUFFIX = ".inito"
+LIST_SUFFIX = ".list"
+
+def find_last_marker(fn: str, marker: bytes):
+    """
+    Locate the line holding the last occurrence of marker, without reading the whole file
+    :return: offset of the start of that line, None if marker does not occur
+    """
+    with open(fn, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            pos = mm.rfind(marker)
+            if pos == -1:
+                return None
+            return mm.rfind(b"\n", 0, pos) + 1
+
+
+def transform_file(fn:str, outfp, engine: str = "line", start_marker: bytes = None):
+    """
+    :param start_marker: only transform from the line holding the last occurrence of start_marker,
+                         nothing if it does not occur
+    """
     if (outfp is None):
         outfp = sys.stdout
-    ztvmode = 1
-    classmode = 1
-    ztvstart = re.compile("\[[0-9]*\]: (_ZTV.*) \[.*\]")
-    ztvend = re.compile(" ENDBLOCK")
-    ztvnormal = re.compile(" SYMOFF: (_ZN.*) \[[0-9,]*\].*")
-    classname = re.compile("\[[0-9]*\]: (_ZN.*class\$E.*) \[.*\]")
-    with open(fn, "r") as f:
-        # Read list of lines
-        out = [] # list to save lines
+    offset = 0
+    if start_marker is not None:
+        offset = find_last_marker(fn, start_marker)
+        if offset is None:
+            return
+    if engine == "mmap" and transform_file_mmap(fn, outfp, offset):
+        return
+    with open(fn, "rb") as raw_f, io.TextIOWrapper(raw_f, encoding=locale.getpreferredencoding(False)) as f:
+        raw_f.seek(offset)
+        transformer = LineTransformer(outfp)
         while True:
             # Read next line
             line = f.readline()
             # If line is blank, then you struck the EOF
             if not line:
                 break
+            transformer.feed(line)
+
+
+class LineTransformer(object):
+    """
+    State machine of the line engine, fed one line of the dump at a time
+    """
+
+    def __init__(self, outfp):
+        self.outfp = outfp
+        self.ztvmode = 1
+        self.classmode = 1
 
-            if classmode == 1:
-                res = re.match(classname, line)
-                if (res is not None):
-                    outfp.write(": "+res.group(1).strip()+"\n")
-
-            if (ztvmode == 1) :
-                # If in ready mode, Find if it's a ZTV start.
-                res = re.match(ztvstart, line)
-                if (res is not None):
-                    ztvmode = 2
-                    # copy to result file
-                    outfp.write(res.group(1).strip() + "\n")
-                pass
+    def feed(self, line: str):
+        outfp = self.outfp
+        if self.classmode == 1:
+            res = re.match(classname, line)
+            if (res is not None):
+                outfp.write(": "+res.group(1).strip()+"\n")
+
+        if (self.ztvmode == 1) :
+            # If in ready mode, Find if it's a ZTV start.
+            res = re.match(ztvstart, line)
+            if (res is not None):
+                self.ztvmode = 2
+                # copy to result file
+                outfp.write(res.group(1).strip() + "\n")
+            pass
+        else:
+            # If in ZTV mode, Find if it's a ZTV end
+            res = re.match(ztvend, line)
+            if (res is not None):
+                self.ztvmode = 1
+                # copy to result file
+                # outfp.write(res.group(1).strip() + "\n")
             else:
-                # If in ZTV mode, Find if it's a ZTV end
-                res = re.match(ztvend, line)
-                if (res is not None):
-                    ztvmode = 1
-                    # copy to result file
-                    # outfp.write(res.group(1).strip() + "\n")
-                else:
-                    res = re.match(ztvnormal, line)
-                    if res:
-                        outfp.write(" " + res.group(1).strip() + "\n")
-                pass
+                res = re.match(ztvnormal, line)
+                if res:
+                    outfp.write(" " + res.group(1).strip() + "\n")
             pass
         pass
-    pass
+
+
+class LastSectionTransformer(object):
+    """
+    Line engine over a dump read as a stream, e.g. from a pipe, only keeping the output of
+    the section starting at the last line holding marker: the output of the current section
+    is held in memory and dropped whenever another marker line comes.
+    Nothing is written if marker never occurs, the same as transform_file with start_marker.
+    """
+
+    def __init__(self, outfp, marker: bytes = INITO_MARKER):
+        self.outfp = outfp
+        self.marker = marker.decode("ascii")
+        self.section = None
+        self.transformer = None
+
+    def feed(self, line: str):
+        if self.marker in line:
+            self.section = io.StringIO()
+            self.transformer = LineTransformer(self.section)
+        if self.transformer is not None:
+            self.transformer.feed(line)
+
+    def feed_file(self, f):
+        """
+        Feed all lines of a text file object, up to its EOF
+        """
+        for line in f:
+            self.feed(line)
+
+    def close(self):
+        if self.section is not None:
+            self.outfp.write(self.section.getvalue())
+            self.section = None
+            self.transformer = None
+
+
+def last_bracket_group(line: bytes, start: int):
+    """
+    End of the greedy group in "(...) \[.*\]": the last " [" followed by a "]", -1 if there is none
+    """
+    return line.rfind(b" [", start, line.rfind(b"]"))
+
+
+def candidate_lines(mm, offset: int = 0):
+    """
+    :return: generator of the candidate lines of a buffer from offset, a line start, without their newline
+    """
+    res = candidate_line.match(mm, offset)
+    if res is not None:
+        yield res.group(0)
+    for res in next_candidate_line.finditer(mm, offset):
+        yield res.group(1)
+
+
+def transform_file_mmap(fn: str, outfp, offset: int = 0):
+    """
+    Same output as the line engine of transform_file, scanning the memory-mapped file as bytes.
+    Only lines starting like one of the patterns are looked at, and the greedy patterns
+    are resolved with rfind instead of backtracking.
+    :return: False if the file needs the line engine, i.e. it has \r line endings or cannot be decoded
+    """
+    encoding = locale.getpreferredencoding(False)
+    out = []
+    ztvmode = 1
+    with open(fn, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return True
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            if mm.find(b"\r", offset) != -1:
+                return False
+            try:
+                for line in candidate_lines(mm, offset):
+                    if line[0:1] == b"[":
+                        start = line.find(b"]: ") + 3
+                        if line[start:start + 3] == b"_ZN":
+                            # classname, the group has to contain class$E after _ZN
+                            end = last_bracket_group(line, start)
+                            if end != -1 and line.find(b"class$E", start + 3, end) != -1:
+                                out.append(": " + line[start:end].decode(encoding).strip() + "\n")
+                        elif ztvmode == 1 and line[start:start + 4] == b"_ZTV":
+                            # ztvstart
+                            end = last_bracket_group(line, start)
+                            if end != -1:
+                                ztvmode = 2
+                                out.append(line[start:end].decode(encoding).strip() + "\n")
+                    elif ztvmode == 2:
+                        if line.startswith(b" ENDBLOCK"):
+                            ztvmode = 1
+                        else:
+                            # ztvnormal, the group ends at the last " [" followed by [0-9,]*]
+                            start = len(b" SYMOFF: ")
+                            end = line.rfind(b" [", start)
+                            while end != -1 and symoff_index.match(line, end + 2) is None:
+                                end = line.rfind(b" [", start, end)
+                            if end != -1:
+                                out.append(" " + line[start:end].decode(encoding).strip() + "\n")
+            except UnicodeDecodeError:
+                return False
+    outfp.write("".join(out))
+    return True
+
+
+def output_name(fn: str):
+    """
+    Name of the .list file of an input in batch mode: X.o.W.inito -> X.o.W.list, X.o.W -> X.o.W.list
+    """
+    if fn.endswith(INITO_SUFFIX):
+        fn = fn[:-len(INITO_SUFFIX)]
+    return fn + LIST_SUFFIX
+
+
+def transform_one(fn: str):
+    """
+    Transform one input of the batch into its .list file, removing a partial output on failure
+    :return: (input, output, error message or None)
+    """
+    out_fn = output_name(fn)
+    try:
+        with open(out_fn, "w") as outfp:
+            transform_file(fn, outfp, all_args.engine if all_args is not None else "line",
+                           INITO_MARKER if all_args is not None and all_args.lastinito else None)
+    except Exception as e:
+        if os.path.exists(out_fn):
+            os.remove(out_fn)
+        return fn, out_fn, str(e)
+    if all_args is not None and all_args.remove:
+        os.remove(fn)
+    return fn, out_fn, None
+
+
+def init_worker(args):
+    global all_args
+    all_args = args
+
+
+def collect_inputs(args):
+    """
+    All inputs of the batch: positional paths, -glob patterns, -list files and NUL-separated paths on stdin
+    """
+    inputs = list(args.inputs)
+    for one_pattern in args.glob:
+        inputs.extend(sorted(glob.glob(one_pattern, recursive=True)))
+    for one_list in args.list:
+        with open(one_list, "r") as f:
+            inputs.extend(line.rstrip("\n") for line in f if line.strip() != "")
+    if args.stdin0:
+        inputs.extend(one_path for one_path in sys.stdin.buffer.read().decode("UTF-8", "surrogateescape").split("\0")
+                      if one_path != "")
+    return inputs
+
+
+def transform_batch(inputs: list, args):
+    """
+    Transform all inputs in a pool of args.jobs processes, printing a "<OK|FAILED>\t<input>" status per input
+    :return: number of failed inputs
+    """
+    failed = 0
+    if args.jobs > 1 and len(inputs) > 1:
+        pool = multiprocessing.Pool(args.jobs, initializer=init_worker, initargs=(args,))
+        results = pool.imap_unordered(transform_one, inputs, chunksize=max(1, min(64, len(inputs) // (4 * args.jobs))))
+    else:
+        pool = None
+        init_worker(args)
+        results = map(transform_one, inputs)
+    try:
+        for fn, out_fn, error in results:
+            if error is None:
+                print("OK\t%s" % fn)
+            else:
+                failed += 1
+                print("FAILED\t%s" % fn)
+                print("Failed to transform %s: %s" % (fn, error), file=sys.stderr)
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    print("Transformed %d of %d files" % (len(inputs) - failed, len(inputs)), file=sys.stderr)
+    return failed
 
 
 def parse_config():
@@ -66,7 +300,28 @@ def parse_config():
                         help="output ztv contents")
     parser.add_argument("-class", "--class", action="store_true",
                         help="output class symbol names")
+    parser.add_argument("-engine", choices=["line", "mmap"], default="line",
+                        help="line: read and match line by line, "
+                             "mmap: scan the memory-mapped file as bytes, faster with the same output")
+    parser.add_argument("-lastinito", action="store_true",
+                        help="only transform the INITOs section of an ir_b2a dump, from the last INITOs: line, "
+                             "instead of a .inito file cut out of the dump")
+    # Batch mode, each input X.o.W.inito (or X.o.W) is transformed into X.o.W.list
+    parser.add_argument("inputs", nargs="*",
+                        help="input files of batch mode")
+    parser.add_argument("-glob", action="append", default=[],
+                        help="batch mode inputs matching this pattern, ** matching directories recursively")
+    parser.add_argument("-list", action="append", default=[],
+                        help="batch mode inputs listed in this file, one per line")
+    parser.add_argument("-stdin0", "-0", action="store_true",
+                        help="batch mode inputs read from stdin, separated by NUL characters (find -print0)")
+    parser.add_argument("-jobs", "-j", type=int, default=os.cpu_count() or 1,
+                        help="number of processes transforming the batch mode inputs")
+    parser.add_argument("-remove", action="store_true",
+                        help="remove each batch mode input once transformed")
     args = parser.parse_args()
+    if args.input is not None and (args.inputs or args.glob or args.list or args.stdin0):
+        parser.error("-input cannot be combined with batch mode inputs")
     all_args = args
     
     return args
@@ -75,5 +330,8 @@ def parse_config():
 
 if __name__ == "__main__":
     args = parse_config()
-    transform_file(args.input.name, args.output)
+    if args.input is not None:
+        transform_file(args.input.name, args.output, args.engine, INITO_MARKER if args.lastinito else None)
+    else:
+        sys.exit(1 if transform_batch(collect_inputs(args), args) > 0 else 0)
 
@@ -0,0 +1,208 @@
+#!/usr/bin/env python3
+import argparse
+import io
+import json
+import locale
+import multiprocessing
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+from common.ArtifactDiscovery import ArtifactDiscovery
+from file_transform import INITO_MARKER, LIST_SUFFIX, LastSectionTransformer
+
+OBJECT_SUFFIX = ".o"
+DUMP_SUFFIX = ".W"
+
+all_args = None
+
+
+class TeeReader(io.RawIOBase):
+    """
+    Raw stream reading from source and copying everything read to copy, to keep the dump for debugging
+    """
+
+    def __init__(self, source, copy):
+        self.source = source
+        self.copy = copy
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        n = self.source.readinto(b)
+        if n:
+            self.copy.write(memoryview(b)[:n])
+        return n
+
+
+def default_ir_b2a():
+    """
+    ir_b2a of the XVSA installation holding $CXX, as generate-irb2a.sh does, else the one on PATH
+    """
+    cxx = os.environ.get("CXX")
+    if cxx:
+        ir_b2a = os.path.join(os.path.realpath(os.path.dirname(os.path.dirname(cxx))), "bin", "ir_b2a")
+        if os.path.isfile(ir_b2a):
+            return ir_b2a
+    return shutil.which("ir_b2a") or "ir_b2a"
+
+
+def generate_one(ir_b2a: str, object_file: str, keep_intermediates: bool = False):
+    """
+    Run ir_b2a on object_file with its dump on a pipe, transforming the last INITOs section
+    of the dump into <object>.W.list as it comes, without writing the dump to disk
+    :param keep_intermediates: also write the dump to <object>.W
+    :return: error message, None on success
+    """
+    dump_fn = object_file + DUMP_SUFFIX
+    list_fn = dump_fn + LIST_SUFFIX
+    tmp_fn = list_fn + ".tmp"
+    dump_fp = open(dump_fn, "wb") if keep_intermediates else None
+    try:
+        proc = subprocess.Popen([ir_b2a, "-st2", object_file, "/dev/stdout"], stdout=subprocess.PIPE)
+    except OSError as e:
+        if dump_fp is not None:
+            dump_fp.close()
+        return "cannot run %s: %s" % (ir_b2a, e)
+    try:
+        source = proc.stdout if dump_fp is None else io.BufferedReader(TeeReader(proc.stdout, dump_fp))
+        with open(tmp_fn, "w") as outfp:
+            transformer = LastSectionTransformer(outfp, INITO_MARKER)
+            transformer.feed_file(io.TextIOWrapper(source, encoding=locale.getpreferredencoding(False)))
+            transformer.close()
+        ret = proc.wait()
+        if ret != 0:
+            os.remove(tmp_fn)
+            return "ir_b2a returned %d" % ret
+        os.replace(tmp_fn, list_fn)
+        return None
+    except Exception as e:
+        proc.kill()
+        proc.wait()
+        if os.path.exists(tmp_fn):
+            os.remove(tmp_fn)
+        return str(e)
+    finally:
+        proc.stdout.close()
+        if dump_fp is not None:
+            dump_fp.close()
+
+
+def find_objects(root: str):
+    """
+    All object files under root, as find -name '*.o' in generate-irb2a.sh
+    """
+    return ArtifactDiscovery((OBJECT_SUFFIX,), prune_patterns=()).scan(os.path.abspath(root))[OBJECT_SUFFIX]
+
+
+def up_to_date(object_file: str):
+    """
+    :return: True if the .W.list of object_file is newer than it.
+             Objects may be placed as hard links keeping the mtime of an older file,
+             linking and renaming update their ctime, so the later of mtime and ctime counts.
+    """
+    list_fn = object_file + DUMP_SUFFIX + LIST_SUFFIX
+    try:
+        object_stat = os.stat(object_file)
+        return os.stat(list_fn).st_mtime_ns >= max(object_stat.st_mtime_ns, object_stat.st_ctime_ns)
+    except OSError:
+        return False
+
+
+def generate_timed(object_file: str):
+    """
+    generate_one in a worker of the pool
+    :return: (object file, error message or None, seconds)
+    """
+    start = time.time()
+    error = generate_one(all_args.irb2a, object_file, all_args.keep_intermediates)
+    return object_file, error, time.time() - start
+
+
+def init_worker(args):
+    global all_args
+    all_args = args
+
+
+def generate_all(objects: list, args):
+    """
+    Generate the .W.list of all objects not up to date in a pool of args.jobs processes
+    :return: summary {"succeeded": [...], "failed": [...], "skipped": [...], ...}
+    """
+    start = time.time()
+    summary = {"ir_b2a": args.irb2a, "jobs": args.jobs, "succeeded": [], "failed": [], "skipped": []}
+    pending = []
+    for one_object in objects:
+        if not args.force and up_to_date(one_object):
+            summary["skipped"].append(one_object)
+        else:
+            pending.append(one_object)
+    if args.jobs > 1 and len(pending) > 1:
+        pool = multiprocessing.Pool(min(args.jobs, len(pending)), initializer=init_worker, initargs=(args,))
+        results = pool.imap_unordered(generate_timed, pending)
+    else:
+        pool = None
+        init_worker(args)
+        results = map(generate_timed, pending)
+    try:
+        for one_object, error, seconds in results:
+            if error is None:
+                summary["succeeded"].append({"object": one_object, "seconds": round(seconds, 3)})
+                print("Completing ... %s" % one_object)
+            else:
+                summary["failed"].append({"object": one_object, "error": error, "seconds": round(seconds, 3)})
+                print("Fail to run ir_b2a on %s, skipping ...: %s" % (one_object, error))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    summary["seconds"] = round(time.time() - start, 3)
+    print("Generated %d, failed %d, up to date %d of %d objects in %.1fs" %
+          (len(summary["succeeded"]), len(summary["failed"]), len(summary["skipped"]), len(objects),
+           summary["seconds"]), file=sys.stderr)
+    return summary
+
+
+def parse_config():
+    parser = argparse.ArgumentParser(description="generate the .W.list file of object files, "
+                                                 "streaming the ir_b2a dump into the transformer")
+    parser.add_argument("objects", nargs="*",
+                        help="object files, <object>.W.list is written next to each, "
+                             "by default all object files under -root")
+    parser.add_argument("-root", default=os.getcwd(),
+                        help="directory searched for object files when none is given, the current one by default")
+    parser.add_argument("-irb2a", default=None,
+                        help="ir_b2a executable, by default the one of the XVSA installation of $CXX, "
+                             "else the one on PATH")
+    parser.add_argument("-keep-intermediates", dest="keep_intermediates", action="store_true",
+                        help="also write the ir_b2a dump of each object to <object>.W, for debugging")
+    parser.add_argument("-jobs", "-j", type=int, default=os.cpu_count() or 1,
+                        help="number of objects processed at the same time")
+    parser.add_argument("-force", action="store_true",
+                        help="also process objects whose .W.list is newer than the object")
+    parser.add_argument("-summary", default=None,
+                        help="write a JSON summary of the succeeded, failed and skipped objects with timings here")
+    args = parser.parse_args()
+    args.irb2a = args.irb2a or default_ir_b2a()
+    return args
+
+
+if __name__ == "__main__":
+    args = parse_config()
+    if args.objects:
+        objects = args.objects
+        for one_object in objects:
+            if not os.path.isfile(one_object):
+                print("Failed to find file %s ..." % one_object)
+                sys.exit(2)
+    else:
+        print("Working in %s" % os.path.abspath(args.root))
+        objects = find_objects(args.root)
+    summary = generate_all(objects, args)
+    if args.summary is not None:
+        with open(args.summary, "w") as f:
+            json.dump(summary, f, indent=2)
+    sys.exit(1 if summary["failed"] else 0)
@@ -19,18 +19,28 @@ IFS=$OLDIFS
 # get length of an array
 tLen=${#fileArray[@]}
 
-process_file() {
-    file_name=$1
-    inito_cnt=$(grep -n "INITOs:" "${file_name}" | awk -F: '{print $1}' | tail -n 1)
-    tail -n "+${inito_cnt}" "${file_name}" > "${file_name}.inito"
-    python3 ${script_dir}/file_transform.py -i "${file_name}.inito"  -o "${file_name}.list"
-    if [ $RET -ne 0 ] ; then
-	rm "${file_name}.list"
-	echo "Failed to transform ${file_name}"
-    else
-	rm "${file_name}" "${file_name}.inito"
+# Number of file_transform.py processes, all CPUs by default
+JOBS=${JOBS:-$(nproc)}
+
+# Dumps are transformed in chunks of TRANSFORM_CHUNK by one file_transform.py each, which removes
+# every .W once transformed: the chunk size bounds the dumps on disk at once, against the start-up
+# cost of one interpreter per chunk
+TRANSFORM_CHUNK=${TRANSFORM_CHUNK:-$((JOBS * 8))}
+pending_dumps=()
+
+transform_pending() {
+    if [ ${#pending_dumps[@]} -eq 0 ] ; then
+	return
     fi
-    
+    # file_transform.py seeks to the last INITOs: line of each dump itself
+    printf '%s\0' "${pending_dumps[@]}" | python3 ${script_dir}/file_transform.py -stdin0 -jobs "${JOBS}" -engine mmap -lastinito -remove > /dev/null
+    for one_dump in "${pending_dumps[@]}"
+    do
+	if [ -f "${one_dump}" ] ; then
+	    echo "Failed to transform ${one_dump}"
+	fi
+    done
+    pending_dumps=()
 }
 
 # use for loop read all filenames
@@ -50,10 +60,15 @@ do
 	    rm "${one_prop}.W"
 	    continue;
 	fi
-	process_file "${one_prop}.W"
+	pending_dumps+=("${one_prop}.W")
+	if [ ${#pending_dumps[@]} -ge ${TRANSFORM_CHUNK} ] ; then
+	    transform_pending
+	fi
     else
 	echo "Failed to find file ${one_prop} ..."
 	exit 2;
     fi
     echo "Completing ... ${one_prop}"
 done
+
+transform_pending
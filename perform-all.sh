@@ -13,7 +13,8 @@ if [ ! -f ${script_dir}/build/libs/verifier.jar ] ; then
     cd ${workdir}
 fi
 
-${script_dir}/generate-irb2a.sh
+# Generate the .W.list of all objects in parallel, skipping the ones already up to date
+python3 ${script_dir}/generate-irb2a.py -summary generate-irb2a-summary.json
 java -jar ${script_dir}/build/libs/verifier.jar $(pwd)
 RET=$?
 echo "Verifier returned ${RET}"
@@ -0,0 +1,244 @@
+#!/usr/bin/env python3
+"""
+Benchmarks for the JFE driver and the preprocessing steps, run one with:
+    python3 run-benchmarks.py <benchmark> [options]
+"""
+import argparse
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from common.ArtifactDiscovery import ArtifactDiscovery
+from common.CompressionUtility import CompressionUtility, TAR_COMPRESSIONS, zstandard
+import file_transform
+
+# Same flags and heap as run-jfe-with-lib-lists.py in library vtable mode
+LIBRARY_FLAGS = ["-allow-phantom-refs=true", "-VTABLE=true", "-libGenOnly=true"]
+JFE_ENV = {"JVM_HEAP": "-Xmx12240m"}
+
+
+def read_list(fn: str):
+    with open(fn, "r") as f:
+        return [line.strip() for line in f if line.strip() != ""]
+
+
+def report(title: str, rows: list):
+    print(title)
+    for one_row in rows:
+        print("  %-24s %s" % one_row)
+
+
+def run_jfe(jfe_script: str, inputs: list, output_file: str):
+    envs = dict(os.environ)
+    envs.update(JFE_ENV)
+    cmd = [jfe_script] + LIBRARY_FLAGS + ["-fC," + one_jar for one_jar in inputs] + ["-fB," + output_file]
+    res = subprocess.run(cmd, env=envs, stdout=subprocess.DEVNULL, stderr=subprocess.STDOUT)
+    if res.returncode != 0:
+        print("jfe failed with %d on %s" % (res.returncode, " ".join(inputs)), file=sys.stderr)
+
+
+def bench_batch_jfe(args):
+    """
+    Throughput of library vtable generation for small jars, one jfe per jar vs. batched jfe processes
+    """
+    jars = [one_jar for one_jar in read_list(args.liblist)
+            if os.path.isfile(one_jar) and os.path.getsize(one_jar) <= args.batchsmall * 1024]
+    if len(jars) == 0:
+        print("No jar up to %d KB in %s" % (args.batchsmall, args.liblist))
+        return
+
+    with tempfile.TemporaryDirectory() as out_dir:
+        start = time.monotonic()
+        for index, one_jar in enumerate(jars):
+            run_jfe(args.jfescript, [one_jar], os.path.join(out_dir, "jar-%d.o" % index))
+        per_jar = time.monotonic() - start
+
+        start = time.monotonic()
+        for index in range(0, len(jars), args.batchmax):
+            run_jfe(args.jfescript, jars[index:index + args.batchmax], os.path.join(out_dir, "batch-%d.o" % index))
+        batched = time.monotonic() - start
+
+    report("library vtable generation, %d jars up to %d KB" % (len(jars), args.batchsmall), [
+        ("per-jar", "%8.2fs  %8.2f jars/s" % (per_jar, len(jars) / per_jar)),
+        ("batched (%d per jfe)" % args.batchmax, "%8.2fs  %8.2f jars/s" % (batched, len(jars) / batched)),
+        ("speed-up", "%8.2fx" % (per_jar / batched)),
+    ])
+
+
+def make_deep_tree(root: str, depth: int, fanout: int, files: int):
+    """
+    Synthetic checkout: every directory holds files and fanout sub-directories down to depth,
+    leaf modules hold their list files next to a class output tree, plus a node_modules subtree
+    :return: number of modules created
+    """
+    modules = 0
+    pending = [(root, 0)]
+    while pending:
+        path, level = pending.pop()
+        for index in range(files):
+            open(os.path.join(path, "Source%d.java" % index), "w").close()
+        if level == depth:
+            for sub_dir in ("classes/com/example", "node_modules/pkg/lib"):
+                os.makedirs(os.path.join(path, sub_dir))
+                for index in range(files):
+                    open(os.path.join(path, sub_dir, "File%d.class" % index), "w").close()
+            open(os.path.join(path, "module.lib.list"), "w").close()
+            open(os.path.join(path, "module.dir.list"), "w").close()
+            modules += 1
+            continue
+        for index in range(fanout):
+            sub_dir = os.path.join(path, "d%d" % index)
+            os.mkdir(sub_dir)
+            pending.append((sub_dir, level + 1))
+    return modules
+
+
+def walk_list_pairs(root: str):
+    """
+    Former discovery: os.walk of the whole tree and pairing by list membership
+    """
+    candidates_lib = []
+    candidates_dir = []
+    for subdir, dirs, files in os.walk(root):
+        for filename in files:
+            filepath = os.path.join(subdir, filename)
+            if filepath.endswith(".lib.list"):
+                candidates_lib.append(filepath[:filepath.rfind(".lib.list")])
+            elif filepath.endswith(".dir.list"):
+                candidates_dir.append(filepath[:filepath.rfind(".dir.list")])
+    return [value for value in candidates_dir if value in candidates_lib]
+
+
+def bench_discovery(args):
+    """
+    Module discovery on a synthetic deep tree, os.walk vs. os.scandir with pruning, serial and parallel
+    """
+    with tempfile.TemporaryDirectory() as root:
+        modules = make_deep_tree(root, args.depth, args.fanout, args.files)
+
+        start = time.monotonic()
+        expected = sorted(walk_list_pairs(root))
+        walked = time.monotonic() - start
+
+        rows = [("os.walk", "%8.3fs" % walked)]
+        for workers in (1, args.workers):
+            start = time.monotonic()
+            found = ArtifactDiscovery.find_list_pairs(root, workers=workers)[0]
+            elapsed = time.monotonic() - start
+            if found != expected:
+                print("scandir with %d workers found %d modules, expected %d" % (workers, len(found), len(expected)),
+                      file=sys.stderr)
+            rows.append(("scandir, %d workers" % workers, "%8.3fs  %8.2fx" % (elapsed, walked / elapsed)))
+
+    report("module discovery, %d modules, depth %d, fanout %d" % (modules, args.depth, args.fanout), rows)
+
+
+def bench_compression(args):
+    """
+    Throughput and ratio of the preprocess archive compressions on the jars of a .lib.list
+    """
+    jars = [one_jar for one_jar in read_list(args.liblist) if os.path.isfile(one_jar)]
+    if len(jars) == 0:
+        print("No jar found in %s" % args.liblist)
+        return
+    total_size = sum(os.path.getsize(one_jar) for one_jar in jars)
+
+    rows = []
+    with tempfile.TemporaryDirectory() as out_dir:
+        for compression in TAR_COMPRESSIONS:
+            if compression == "zstd" and zstandard is None:
+                rows.append((compression, "skipped, zstandard is not installed"))
+                continue
+            tarball_fn = os.path.join(out_dir, "preprocess.tar." + compression)
+            start = time.monotonic()
+            with CompressionUtility.open_tar_writer(tarball_fn, compression, args.level) as tf:
+                for index, one_jar in enumerate(jars):
+                    tf.add(one_jar, arcname="lib-%d.dir/jarfiles/lib-%d.jar" % (index, index))
+            elapsed = time.monotonic() - start
+            rows.append((compression, "%8.2fs  %8.1f MB/s  ratio %5.3f" %
+                         (elapsed, total_size / (1024 * 1024) / elapsed, os.path.getsize(tarball_fn) / total_size)))
+            os.remove(tarball_fn)
+
+    report("preprocess archive compression, %d jars, %.1f MB" % (len(jars), total_size / (1024 * 1024)), rows)
+
+
+def make_whirl_dump(fn: str, size_mb: int):
+    """
+    Synthetic ir_b2a -st2 dump: symbol table lines with long mangled names, vtable blocks
+    of SYMOFF lines, and unrelated WHIRL lines making up most of the file
+    """
+    index = 0
+    with open(fn, "w") as f:
+        while f.tell() < size_mb * 1024 * 1024:
+            name = "N3com7example" + "".join("%d%s" % (len("Pkg%d" % k), "Pkg%d" % k) for k in range(index % 12 + 4))
+            f.write("[%d]: _ZN%s6class$EE <1,%d> [class, 0, %d]\n" % (index, name, index, index))
+            f.write("[%d]: _ZTV%sE <1,%d> [vtable, 0, %d]\n" % (index, name, index, index))
+            for k in range(8):
+                f.write(" SYMOFF: _ZN%s6methodEv%d [%d,%d] <offset %d>\n" % (name, k, k, k * 8, k * 8))
+            f.write(" ENDBLOCK\n")
+            for k in range(40):
+                f.write("  U8U8LDID 0 <2,%d,tmp%d> T<9,anon_ptr.,8> [line %d]\n" % (index, k, k))
+            index += 1
+
+
+def bench_transform(args):
+    """
+    transform_file on a large WHIRL dump, line engine vs. mmap engine
+    """
+    with tempfile.TemporaryDirectory() as out_dir:
+        dump_fn = os.path.join(out_dir, "bench.o.W")
+        make_whirl_dump(dump_fn, args.size)
+        size_mb = os.path.getsize(dump_fn) / (1024 * 1024)
+
+        rows = []
+        outputs = {}
+        for engine in ("line", "mmap"):
+            outfp = io.StringIO()
+            start = time.monotonic()
+            file_transform.transform_file(dump_fn, outfp, engine)
+            elapsed = time.monotonic() - start
+            outputs[engine] = outfp.getvalue()
+            rows.append((engine, "%8.2fs  %8.1f MB/s" % (elapsed, size_mb / elapsed)))
+        if outputs["line"] != outputs["mmap"]:
+            print("mmap engine output differs from the line engine", file=sys.stderr)
+
+    report("transform of a %.1f MB WHIRL dump" % size_mb, rows)
+
+
+def parse_config():
+    parser = argparse.ArgumentParser(description="benchmarks for the jfe driver and preprocessing")
+    benchmarks = parser.add_subparsers(dest="benchmark")
+    benchmarks.required = True
+
+    batch_jfe = benchmarks.add_parser("batch-jfe", help="per-jar vs. batched library vtable generation")
+    batch_jfe.add_argument("-jfescript", "-j", required=True, help="specify mapfej location")
+    batch_jfe.add_argument("-liblist", "-l", required=True, help="a .lib.list file with the jars to generate")
+    batch_jfe.add_argument("-batchsmall", type=int, default=256, help="only use jars up to this size, in KB")
+    batch_jfe.add_argument("-batchmax", type=int, default=32, help="number of jars in one batched jfe")
+    batch_jfe.set_defaults(func=bench_batch_jfe)
+
+    discovery = benchmarks.add_parser("discovery", help="os.walk vs. scandir module discovery")
+    discovery.add_argument("-depth", type=int, default=5, help="depth of the synthetic tree")
+    discovery.add_argument("-fanout", type=int, default=4, help="sub-directories of each directory")
+    discovery.add_argument("-files", type=int, default=20, help="files in each directory")
+    discovery.add_argument("-workers", type=int, default=8, help="directories scanned at the same time")
+    discovery.set_defaults(func=bench_discovery)
+
+    compression = benchmarks.add_parser("compression", help="preprocess archive compressions")
+    compression.add_argument("-liblist", "-l", required=True, help="a .lib.list file with the jars to archive")
+    compression.add_argument("-level", type=int, default=None, help="compression level, default of each compression")
+    compression.set_defaults(func=bench_compression)
+
+    transform = benchmarks.add_parser("transform", help="line vs. mmap engine of file_transform.py")
+    transform.add_argument("-size", type=int, default=200, help="size of the synthetic WHIRL dump, in MB")
+    transform.set_defaults(func=bench_transform)
+
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_config()
+    args.func(args)
@@ -4,32 +4,56 @@ import logging
 import glob
 import logging
 import os
-import random
 import shutil
 import tarfile
 import tempfile
 import json
 import shlex
 import zipfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
 
-from common.CommandLineUtility import CommandLineUtility
-from common.CompressionUtility import CompressionUtility
+from common.AdmissionController import MemoryAdmissionController
+from common.ArtifactDiscovery import ArtifactDiscovery, DEFAULT_PRUNE_PATTERNS, LIB_LIST_SUFFIX
+from common.CommandLineUtility import CommandLineUtility, OutputTail
+from common.CompressionUtility import CompressionUtility, TAR_COMPRESSIONS
 from common.ConfigObject import ConfigObject
+from common.HashCache import HashCache
 from common.HashUtility import HashUtility
+from common.IncrementalArchive import IncrementalTarWriter
+from common.ModuleIndex import ModuleIndex
+from common.ObjectCache import ObjectCache
+from common.TargetNameAllocator import TargetNameAllocator
 from common.CommonGlobals import TaskErrorNo
 from common.FileUtility import FileUtility
 from common.XcalException import XcalException
+from common.SystemMonitor import SystemSampler
 from common.XcalLogger import XcalLogger
 from common.CommonGlobals import *
 
 all_args = None
 import time
 import datetime
+import collections
+import contextlib
+import functools
 import psutil
 import subprocess
+import threading
+
+# Preprocess archive
+CLASSES_JAR_SPOOL_SIZE = 64 * 1024 * 1024 #In bytes, classes.jar larger than this are spooled to a temporary file
+CLASSES_JAR_CACHE_SUFFIX = ".jars" # Next to an incremental archive, the module jars of the previous run
 
 # Logging
-MAX_LOG_DUMP_SIZE = 2000 #In bytes
+MAX_LOG_DUMP_SIZE = 64 * 1024 #In bytes, the tail of the jfe output kept in memory for failure reports
+
+# Fingerprint of the inputs of an application object, next to the object
+MANIFEST_SUFFIX = ".manifest.json"
+
+# Combined object of small library jars, batch-<key>.o
+BATCH_PREFIX = "batch-"
+# Objects of the libraries of a module, next to its .lib.list
+LIB_OUTPUT_LIST_SUFFIX = ".lib.output.list"
 
 # JFE Environment variable
 CUSTOM_ENV = {"JVM_HEAP": "-Xmx12240m"}
@@ -44,38 +68,164 @@ System info with Psutil
  
 EXPAND = 1024 * 1024
  
+
+class SharedResource(object):
+    """
+    Resource created on first use by factory, then shared by all JFE invocations of this process
+    """
+
+    def __init__(self, factory):
+        self.factory = factory
+        self.lock = threading.Lock()
+        self.created = False
+        self.value = None
+
+    def get(self, *args):
+        """
+        :param args: passed to the factory on first use
+        :return: the resource, None if the factory disabled it
+        """
+        with self.lock:
+            if not self.created:
+                self.value = self.factory(*args)
+                self.created = True
+            return self.value
+
+    def peek(self):
+        """
+        :return: the resource if it was created, else None
+        """
+        return self.value
+
+    def close(self):
+        """
+        Close the resource if it was created
+        """
+        with self.lock:
+            if self.value is not None:
+                self.value.close()
+
+
+# Library object cache, None if disabled
+object_cache = SharedResource(lambda conf: None if conf.nocache else
+                              ObjectCache(conf.cachedir, XcalLogger("run-jfe-with-lib-lists", "cache"),
+                                          max_size=conf.cachesize * EXPAND))
+
+
+def get_object_cache(conf):
+    return object_cache.get(conf)
+
+
+# Persistent digests of the library jars, None if disabled
+hash_cache = SharedResource(lambda conf: None if conf.nohashcache else
+                            HashCache(conf.hashcache, XcalLogger("run-jfe-with-lib-lists", "hash-cache")))
+library_hashes = {}
+library_hashes_lock = threading.Lock()
+
+
+def prefetch_library_hashes(lib_paths):
+    """
+    Hash the library files not hashed yet by this process at once, on a thread pool,
+    through the persistent hash cache unless it is disabled
+    """
+    with library_hashes_lock:
+        missing = [one_lib for one_lib in set(lib_paths) if one_lib not in library_hashes]
+    if len(missing) == 0:
+        return
+    if hash_cache.peek() is not None:
+        digests = hash_cache.peek().get_digests(missing)
+    else:
+        digests = dict((one_lib, one_digests["sha256"])
+                       for one_lib, one_digests in HashUtility.get_files_digests(missing).items())
+    with library_hashes_lock:
+        library_hashes.update(digests)
+
+
+def get_library_hash(lib_path: str):
+    with library_hashes_lock:
+        lib_hash = library_hashes.get(lib_path)
+    if lib_hash is None:
+        prefetch_library_hashes([lib_path])
+        with library_hashes_lock:
+            lib_hash = library_hashes[lib_path]
+    return lib_hash
+
+
+@functools.lru_cache(maxsize=None)
+def get_jfe_identity(jfe_script: str):
+    """
+    Identify the mapfej binary, so that objects generated by another JFE are not reused
+    """
+    stat = os.stat(jfe_script)
+    return "%s:%d:%d:%s" % (os.path.realpath(jfe_script), stat.st_size, stat.st_mtime_ns,
+                            HashUtility.get_sha256_hash(jfe_script))
+
+
+# Persistent index of parsed .lib.list/.dir.list files, None if disabled
+module_index = SharedResource(lambda conf: None if conf.nomoduleindex else
+                              ModuleIndex(conf.moduleindex, XcalLogger("run-jfe-with-lib-lists", "module-index")))
+
+
+def get_module_index(conf):
+    return module_index.get(conf)
+
+
+def read_list_file(fn: str, conf):
+    """
+    Read a .lib.list/.dir.list file, through the module index unless it is disabled
+    """
+    index = get_module_index(conf)
+    if index is None:
+        return read_file(fn)
+    return index.read_list(fn)
+
+
+# Background sampler of host CPU/memory
+system_sampler = SharedResource(lambda: SystemSampler().start())
+
+
+def get_system_sampler():
+    return system_sampler.get()
+
+
 def mems_available():
     ''' Memory '''
-    mem = psutil.virtual_memory()
-    swap_mem = psutil.swap_memory()
-    physical_memory_total = mem.total
-    mem_str = " Memory Status:\n"
-    mem_str += "   swap total : %d MB\n" % (swap_mem.total / EXPAND)
-    mem_str += "   swap free : %d MB\n" % (swap_mem.free / EXPAND)
-    mem_str += "   free: %s MB\n" % str(mem.free / EXPAND)
-    mem_str += "   total: " + str(physical_memory_total / EXPAND) + " MB\n"
-    mem_str += "   used: " + str(mem.used / EXPAND) + " MB\n"
-    mem_str += "   available: " + str(mem.available / EXPAND) + " MB\n"
-    mem_str += "   available percentage: %d / 100 \n"  % int(mem.available / physical_memory_total * 100)
-    logging.info (mem_str)
-    if ((mem.available) / (physical_memory_total)) < MEM_FREE_PERCENT :
+    snapshot = get_system_sampler().snapshot()
+    if snapshot.mem_available_mb / snapshot.mem_total_mb < MEM_FREE_PERCENT:
         return False
     return True
  
  
 def cpus_available():
     ''' CPU Info '''
-    cpu_str = " CPU Info:\n"
-    cpu_status = psutil.cpu_times()
-    cpu_str += "   user = " + str(cpu_status.user) + "\n"
-    cpu_str += "   system = " + str(cpu_status.system) + "\n"
-    cpu_str += "   idle = " + str(cpu_status.idle) + "\n"
-    cpu_str += "   used percentage = %d / 100 \n" %  int(cpu_status.user / (cpu_status.idle + cpu_status.user + cpu_status.system))
-    logging.info(cpu_str)
-    if cpu_status.user / (cpu_status.idle + cpu_status.user + cpu_status.system) > CPU_MAX:
+    snapshot = get_system_sampler().snapshot()
+    if snapshot.cpu_percent_avg > CPU_MAX * 100:
         return False
     return True
 
+def create_admission_controller(conf):
+    """
+    Create the memory admission controller of jfe heaps.
+    The budget defaults to the memory available now, minus MEM_FREE_PERCENT of the total kept free.
+    """
+    if conf.membudget is not None:
+        budget_mb = int(conf.membudget)
+    else:
+        mem = psutil.virtual_memory()
+        budget_mb = int((mem.available - mem.total * MEM_FREE_PERCENT) / EXPAND)
+    logging.info("Memory budget for jfe: %d MB" % budget_mb)
+    return MemoryAdmissionController(budget_mb, XcalLogger("run-jfe-with-lib-lists", "admission"),
+                                     host_ready=get_system_info_ready,
+                                     recheck_interval=get_system_sampler().interval)
+
+
+admission_controller = SharedResource(create_admission_controller)
+
+
+def get_admission_controller(conf):
+    return admission_controller.get(conf)
+
+
 def get_system_info_ready():
     if not(mems_available()):  # mem
         return False 
@@ -117,7 +267,10 @@ def parse_config():
     parser.add_argument("-wholedir", "-w",
                         required=False,
                         help="specify output location")
-    parser.add_argument("-jfescript", "-j", type=argparse.FileType('rb'), required=True,
+    parser.add_argument("command", nargs="?", choices=["run", "stats", "collect"], default="run",
+                        help="run the jfe (default), report the library object cache stats, "
+                             "or collect the libraries and class files of -wholedir into -tarball")
+    parser.add_argument("-jfescript", "-j", type=argparse.FileType('rb'), required=False,
                         help="specify mapfej location")
     parser.add_argument("-timeout", "-t", required=False, default=3600,
                         help="specify timeout duration, in seconds")
@@ -126,7 +279,60 @@ def parse_config():
                         help="increase output verbosity")
     parser.add_argument("-library", action="store_true",
                         help="enable library mode instead of app mode", required=False)
+    parser.add_argument("-jobs", type=int, required=False, default=1,
+                        help="number of jfe jobs to run in parallel in whole-dir mode")
+    parser.add_argument("-membudget", type=int, required=False, default=None,
+                        help="memory in MB that running jfe heaps may reserve, defaults to the available memory")
+    parser.add_argument("-cachedir", required=False, default=ObjectCache.DEFAULT_CACHE_DIR,
+                        help="host-wide directory caching library objects by jar content, mapfej and flags")
+    parser.add_argument("-cachesize", type=int, required=False, default=20480,
+                        help="maximum size of the library object cache, in MB")
+    parser.add_argument("-nocache", action="store_true", required=False,
+                        help="disable the library object cache")
+    parser.add_argument("-batchsmall", type=int, required=False, default=0,
+                        help="generate jars up to this size, in KB, as combined objects of several jars "
+                             "in one jfe process, 0 to disable")
+    parser.add_argument("-batchmax", type=int, required=False, default=32,
+                        help="number of small jars in one combined object, batches of jars used by the same "
+                             "modules are split by jar hash into about this size")
+    parser.add_argument("-logdir", required=False, default="jfe-logs",
+                        help="directory of the per-job jfe log files")
+    parser.add_argument("-compresslogs", action="store_true", required=False,
+                        help="gzip each jfe log file once the jfe finished")
+    parser.add_argument("-prune", required=False, default=",".join(DEFAULT_PRUNE_PATTERNS),
+                        help="comma separated directory name patterns not searched in whole-dir mode")
+    parser.add_argument("-scanworkers", type=int, required=False, default=1,
+                        help="directories searched at the same time in whole-dir mode, "
+                             "worth raising on network file systems")
+    parser.add_argument("-moduleindex", required=False, default=ModuleIndex.DEFAULT_INDEX_FILE,
+                        help="file indexing the parsed .lib.list/.dir.list files across runs")
+    parser.add_argument("-nomoduleindex", action="store_true", required=False,
+                        help="always parse the .lib.list/.dir.list files")
+    parser.add_argument("-tarball", required=False, default=PREPROCESS_FILE_NAME,
+                        help="preprocess archive written by the collect command")
+    parser.add_argument("-compression", required=False, choices=TAR_COMPRESSIONS, default="gz",
+                        help="compression of the preprocess archive, gz-parallel compresses on all CPUs")
+    parser.add_argument("-compresslevel", type=int, required=False, default=None,
+                        help="compression level of the preprocess archive, defaults to the compression's own")
+    parser.add_argument("-incremental", action="store_true", required=False,
+                        help="keep a manifest and the module jars next to -tarball, so that the next collect "
+                             "only zips the modules whose class files changed")
+    parser.add_argument("-delta", required=False, default=None,
+                        help="also write the archive members changed since the previous collect to this archive, "
+                             "with a delta-manifest.json, implies -incremental")
+    parser.add_argument("-hashcache", required=False, default=HashCache.DEFAULT_CACHE_FILE,
+                        help="file caching the digests of library jars by inode, size and mtime across runs")
+    parser.add_argument("-nohashcache", action="store_true", required=False,
+                        help="hash every library jar again")
+    parser.add_argument("-force", action="store_true", required=False,
+                        help="regenerate application objects even if their inputs did not change")
+    parser.add_argument("-failfast", action="store_true", required=False,
+                        help="stop scheduling jfe jobs after the first failure in whole-dir mode")
     args = parser.parse_args()
+    if args.command == "run" and args.jfescript is None:
+        parser.error("the following arguments are required: -jfescript/-j")
+    if args.command == "collect" and args.wholedir is None:
+        parser.error("the following arguments are required: -wholedir/-w")
     all_args = args
 
     return args
@@ -208,15 +414,28 @@ class ProcessTimer:
 
 class CollectDependentBytecodeTasks(object):
 
-    def __init__(self, logger: XcalLogger):
+    def __init__(self, logger: XcalLogger, module_index: ModuleIndex = None,
+                 prune_patterns: tuple = DEFAULT_PRUNE_PATTERNS, scan_workers: int = 1):
+        """
+        :param module_index: index of the parsed list files, None to parse every list file
+        :param prune_patterns: directory name patterns not searched for list files
+        :param scan_workers: directories searched at the same time
+        """
         self.logger = logger
+        self.module_index = module_index
+        self.prune_patterns = prune_patterns
+        self.scan_workers = scan_workers
 
-    def run(self, artifact_root:str, tarball_fn:str):
+    def run(self, artifact_root:str, tarball_fn:str, compression: str = "gz", level: int = None,
+            incremental: bool = False, delta_fn: str = None):
         """
         Collect the result from Maven/Gradle Plugins
-        :param global_ctx:
-        :param job_config:
-        :param step_config:
+        :param artifact_root: directory searched for the .lib.list/.dir.list files
+        :param tarball_fn: the preprocess archive to write
+        :param compression: one of TAR_COMPRESSIONS
+        :param level: compression level, None for the default of the compression
+        :param incremental: keep a manifest and the module jars next to tarball_fn, to reuse them in the next run
+        :param delta_fn: also write the members changed since the previous run to this archive, implies incremental
         :return:
         """
         with XcalLogger("CollectDependentBytecodeTasks", "run", parent=self.logger) as log:
@@ -228,7 +447,7 @@ class CollectDependentBytecodeTasks(object):
                                     ("Cannot locate the artifact root", "artifact_root = %s" % artifact_root),
                                     TaskErrorNo.E_PRESCAN_RESULT_DIR_NONEXIST)
 
-            all_target_names = set()
+            all_target_names = TargetNameAllocator()
             all_dirs_dict = {}
             all_libs_dict = {}
             viable_modules = self.find_modules(all_dirs_dict, all_libs_dict, all_target_names, artifact_root)
@@ -239,21 +458,30 @@ class CollectDependentBytecodeTasks(object):
                                     TaskErrorNo.E_NO_VIABLE_MIDDLE_RESULT)
 
             log.trace("Searching for modules completed", ("Viable modules' size =", len(viable_modules)))
+            incremental = incremental or delta_fn is not None
+            manifest_file = tarball_fn + IncrementalTarWriter.MANIFEST_SUFFIX
+            previous_manifest = IncrementalTarWriter.load_manifest(manifest_file) if incremental else None
+            jar_cache_dir = tarball_fn + CLASSES_JAR_CACHE_SUFFIX if incremental else None
             try:
                 # Write the entire preprocess.tar.gz file.
-                with tarfile.open(tarball_fn, "w:gz") as tf:
+                with CompressionUtility.open_tar_writer(tarball_fn, compression, level) as tf, \
+                        (CompressionUtility.open_tar_writer(delta_fn, compression, level) if delta_fn is not None
+                         else contextlib.nullcontext()) as delta_tf:
+                    archive = IncrementalTarWriter(tf, previous_manifest, delta_tf, get_library_hash)
                     # Add all libs, with their target/xcalibyte.properties and target/jarfiles
-                    for one_lib_path, one_lib_id in all_libs_dict.items():
-                        tf.add(one_lib_path,
-                               arcname=("%s.dir" + os.sep + "jarfiles" + os.sep + "%s.jar") % (one_lib_id, one_lib_id))
-                        self.write_library_properties(one_lib_id, one_lib_path, tf)
+                    self.add_all_libraries(all_libs_dict, archive)
 
                     # Add all modules with their related  target/xcalibyte.properties and target/jarfiles
-                    self.add_all_app_modules(all_libs_dict, tf, viable_modules)
+                    self.add_all_app_modules(all_libs_dict, archive, viable_modules, jar_cache_dir)
 
                     # Write two global properties files
-                    self.write_global_properties(tf, viable_modules)
+                    self.write_global_properties(archive, viable_modules)
+                    archive.finish()
                 pass
+                if incremental:
+                    archive.save_manifest(manifest_file)
+                    log.info("Incremental archive", "%d members changed, %d removed since the previous archive" %
+                             (len(archive.changed), len(archive.removed())))
 
             except FileNotFoundError as err:
                 raise XcalException("CollectDependentBytecodeTasks", "run",
@@ -262,7 +490,8 @@ class CollectDependentBytecodeTasks(object):
 
             log.trace("Dumping preprocess file complete", ("Archive saved to = ", tarball_fn))
 
-    def find_modules(self, all_dirs_dict: dict, all_lib_dict: dict, all_target_names: set, artifact_root: str):
+    def find_modules(self, all_dirs_dict: dict, all_lib_dict: dict, all_target_names: TargetNameAllocator,
+                     artifact_root: str):
         """
         Find all modules in the artifact_root that has a
         matching .lib.list/.dir.list file generated
@@ -273,27 +502,11 @@ class CollectDependentBytecodeTasks(object):
 
         :return viable modules in {moduleName: {"libList":..., "dirList": ..., "path": ...}}
         """
-        # ------------------------------------
-        # Collect all lib files & class dirs from .lib.list and .dir.list
-        # ------------------------------------
-        candidates_lib = []
-        candidates_dir = []
-        for root, dirs, files in os.walk(artifact_root):
-            for filename in files:
-                filepath = os.path.join(root, filename)
-                if filepath.endswith(".lib.list"):
-                    candidates_lib.append(filepath[:filepath.rfind(".lib.list")])
-                elif filepath.endswith(".dir.list"):
-                    candidates_dir.append(filepath[:filepath.rfind(".dir.list")])
-                pass
-            pass
-        viable_candidates = [value for value in candidates_dir if value in candidates_lib]
+        viable_candidates = find_module_candidates(artifact_root, self.logger, self.prune_patterns,
+                                                   self.scan_workers)
         viable_modules = {}
-        if len(candidates_dir) != len(candidates_lib) or len(candidates_lib) != len(viable_candidates):
-            self.logger.warn("Find candidates",
-                             "Cannot find equal candidates among lib and dir files, "
-                             "since len[viable-candidates] = %d, len[candidates-dir] = %d, len[candidates-lib] = %d " %
-                             (len(viable_candidates), len(candidates_dir), len(candidates_lib)))
+        # Class-file dirs are named apart, so that they never shift the names of jars and modules
+        all_dir_names = TargetNameAllocator()
 
         # ------------------------------------
         # Read entries in libraries and dir lists, into a dict.
@@ -301,19 +514,18 @@ class CollectDependentBytecodeTasks(object):
         for one_lib_file in viable_candidates:
             if (os.path.exists(one_lib_file + ".lib.list") and
                     os.path.exists(one_lib_file + ".dir.list")):
-                lib_list = read_file(one_lib_file + ".lib.list")
-                dir_list = read_file(one_lib_file + ".dir.list")
+                lib_list = self.read_list(one_lib_file + ".lib.list")
+                dir_list = self.read_list(one_lib_file + ".dir.list")
 
                 for one_lib in lib_list:
                     if all_lib_dict.get(one_lib) is None:
                         one_lib_id = self.get_target_name_from_filepath(all_target_names, one_lib)
                         all_lib_dict[one_lib] = one_lib_id
-                        all_target_names.add(one_lib_id)
 
                 in_module_dirs = set()
                 for one_dir in dir_list:
                     if all_dirs_dict.get(one_dir) is None:
-                        one_dir_id = self.get_target_name_from_filepath(all_target_names, one_dir)
+                        one_dir_id = self.get_target_name_from_filepath(all_dir_names, one_dir)
                         all_dirs_dict[one_dir] = one_dir_id
                         in_module_dirs.add(one_dir_id)
 
@@ -323,77 +535,183 @@ class CollectDependentBytecodeTasks(object):
                                               "path": os.path.dirname(one_lib_file), "srcDirList": []}
                 pass
             pass
+        if all_target_names.collisions > 0:
+            self.logger.warn("Conflicting names for targets, probably jars",
+                             "%d names disambiguated by path hash" % all_target_names.collisions)
         return viable_modules
 
-    def get_target_name_from_filepath(self, all_target_names: set, one_lib: str):
+    def read_list(self, fn: str):
+        if self.module_index is None:
+            return read_file(fn)
+        return self.module_index.read_list(fn)
+
+    def get_target_name_from_filepath(self, all_target_names: TargetNameAllocator, one_lib: str):
         """
         Calculate the module's target-name from jar file path or non-jar prefixes
-        :param all_target_names:
+        :param all_target_names: names allocated so far, the new name is added to them
         :param one_lib:
         :return:
         """
-        one_lib_id = os.path.basename(one_lib).replace(".", "-").replace(" ", "")
-        while one_lib_id in all_target_names:
-            # Conflict in name
-            one_lib_id = one_lib_id + "X"
-            self.logger.warn("Conflicting names for targets, probably jars", one_lib)
-        return one_lib_id
-
-    def add_all_app_modules(self, all_lib_dict: dict, tf: tarfile.TarFile, viable_modules: dict):
+        return all_target_names.allocate(one_lib)
+
+    def add_all_libraries(self, all_lib_dict: dict, archive: IncrementalTarWriter):
+        """
+        Add all libraries with their xcalibyte.properties file into the archive.
+        A jar with the same content as a jar added before, found at another path,
+        is added as a hard link to it instead of a second copy.
+        """
+        # Only jars sharing their size with another jar may be duplicates, and need to be hashed
+        size_count = collections.Counter()
+        for one_lib_path in all_lib_dict:
+            if os.path.isfile(one_lib_path):
+                size_count[os.path.getsize(one_lib_path)] += 1
+
+        added_by_hash = {}
+        dedup_count = 0
+        dedup_size = 0
+        for one_lib_path, one_lib_id in all_lib_dict.items():
+            arcname = ("%s.dir" + os.sep + "jarfiles" + os.sep + "%s.jar") % (one_lib_id, one_lib_id)
+            lib_hash = None
+            if os.path.isfile(one_lib_path) and (archive.tracking or size_count[os.path.getsize(one_lib_path)] > 1):
+                lib_hash = archive.file_digest(one_lib_path, arcname)
+            if lib_hash is not None and lib_hash in added_by_hash:
+                archive.add_hardlink(one_lib_path, arcname, added_by_hash[lib_hash])
+                dedup_count += 1
+                dedup_size += os.path.getsize(one_lib_path)
+            else:
+                archive.add_file(one_lib_path, arcname, lib_hash)
+                if lib_hash is not None:
+                    added_by_hash[lib_hash] = arcname
+            self.write_library_properties(one_lib_id, one_lib_path, archive)
+
+        if dedup_count > 0:
+            self.logger.info("Deduplicated libraries", "%d jars, %.1f MB, stored as hard links" %
+                             (dedup_count, dedup_size / EXPAND))
+
+    def add_all_app_modules(self, all_lib_dict: dict, archive: IncrementalTarWriter, viable_modules: dict,
+                            jar_cache_dir: str = None):
         """
         Add all modules with their class-file directories and xcalibyte.properties file into the archive.
+        :param jar_cache_dir: directory keeping the module jars by class-file dirs fingerprint,
+                              a module whose class files did not change reuses its jar; None to always zip
         """
+        if jar_cache_dir is not None:
+            os.makedirs(jar_cache_dir, exist_ok=True)
+        used_jars = set()
+        reused_count = 0
         for module_name, module_info in viable_modules.items():
-            # Compress the class-file dirs into one Jar.
-            with tempfile.NamedTemporaryFile("wb") as prop_f:
-                with zipfile.ZipFile(prop_f.name, 'w', zipfile.ZIP_STORED) as zipf:
-                    for one_dir in module_info.get("dirList"):
-                        CompressionUtility.add_dir_to_zip_file(one_dir, zipf)
-                tf.add(prop_f.name, ("%s.dir" + os.sep + "jarfiles" + os.sep + "classes.jar") % module_name)
-
+            arcname = ("%s.dir" + os.sep + "jarfiles" + os.sep + "classes.jar") % module_name
+            if jar_cache_dir is None:
+                # Compress the class-file dirs into one Jar, in memory unless it gets large
+                with tempfile.SpooledTemporaryFile(max_size=CLASSES_JAR_SPOOL_SIZE) as jar_f:
+                    with zipfile.ZipFile(jar_f, 'w', zipfile.ZIP_STORED) as zipf:
+                        CompressionUtility.add_dirs_to_zip_file(module_info.get("dirList"), zipf)
+                    jar_size = jar_f.tell()
+                    jar_f.seek(0)
+                    archive.add_fileobj(arcname, jar_f, jar_size)
+                continue
 
-    def write_library_properties(self, one_lib_id: str, one_lib_path: str, tf: tarfile.TarFile):
+            fingerprint = IncrementalTarWriter.dirs_fingerprint(module_info.get("dirList"))
+            jar_path = os.path.join(jar_cache_dir, fingerprint.split(":")[-1] + ".jar")
+            used_jars.add(jar_path)
+            if os.path.isfile(jar_path):
+                reused_count += 1
+            else:
+                with tempfile.NamedTemporaryFile("wb", dir=jar_cache_dir, suffix=".tmp", delete=False) as jar_f:
+                    with zipfile.ZipFile(jar_f, 'w', zipfile.ZIP_STORED) as zipf:
+                        CompressionUtility.add_dirs_to_zip_file(module_info.get("dirList"), zipf)
+                os.replace(jar_f.name, jar_path)
+            with open(jar_path, "rb") as jar_f:
+                archive.add_fileobj(arcname, jar_f, os.path.getsize(jar_path),
+                                    archive.previous_digest(arcname, fingerprint), fingerprint)
+
+        if jar_cache_dir is not None:
+            # Jars of class files that changed or of modules that are gone
+            for one_entry in os.scandir(jar_cache_dir):
+                if one_entry.path not in used_jars:
+                    os.remove(one_entry.path)
+            self.logger.info("Module jars", "%d of %d reused from %s" %
+                             (reused_count, len(viable_modules), jar_cache_dir))
+
+
+    def write_library_properties(self, one_lib_id: str, one_lib_path: str, archive: IncrementalTarWriter):
         """
         Writing a per-library properties file, marking that it is compile_only and vtable_only
         :return:
         """
-        with tempfile.NamedTemporaryFile("w+") as lib_f:
-            lib_f.write("version=1.0\n")
-            lib_f.write("project=%s\n" % one_lib_id)
-            lib_f.write("project_key=%s\n" % one_lib_id)
-            lib_f.write("compile_only=true\n")
-            lib_f.write("vtable_only=true\n")
-            lib_f.write("xc5_root_dir=%s\n" % one_lib_path)
-            lib_f.flush()
-            tf.add(lib_f.name, ("%s.dir" + os.sep + "xcalibyte.properties") % one_lib_id)
-            pass
-
-    def write_global_properties(self, tf:tarfile.TarFile, viable_modules:dict):
+        properties = ("version=1.0\n"
+                      "project=%s\n"
+                      "project_key=%s\n"
+                      "compile_only=true\n"
+                      "vtable_only=true\n"
+                      "xc5_root_dir=%s\n") % (one_lib_id, one_lib_id, one_lib_path)
+        archive.add_bytes(("%s.dir" + os.sep + "xcalibyte.properties") % one_lib_id, properties.encode("UTF-8"))
+
+    def write_global_properties(self, archive: IncrementalTarWriter, viable_modules:dict):
         # Write to all-in-one xcalibyte.properties
-        with tempfile.NamedTemporaryFile("w+") as tmp:
-            # Add a single file
-            tmp.write("version=1.0\n")
-            tmp.write("project=0000-0000-000000000\n")
-            tmp.write("project_key=root\n")
-            tmp.write("build_command=mvn.......\n")
-            tmp.write("compile_only=false\n")
-            tmp.flush()
-            tf.add(tmp.name, "java.scan" + os.sep + "xcalibyte.properties")
-            tf.add(tmp.name, "xcalibyte.properties")
+        properties = ("version=1.0\n"
+                      "project=0000-0000-000000000\n"
+                      "project_key=root\n"
+                      "build_command=mvn.......\n"
+                      "compile_only=false\n").encode("UTF-8")
+        archive.add_bytes("java.scan" + os.sep + "xcalibyte.properties", properties)
+        archive.add_bytes("xcalibyte.properties", properties)
 
         # Write to modules.json
-        with  tempfile.NamedTemporaryFile("w+") as json_tmp:
-            json.dump(viable_modules, json_tmp)
-            json_tmp.flush()
-            tf.add(json_tmp.name, "modules.json")
+        archive.add_bytes("modules.json", json.dumps(viable_modules).encode("UTF-8"))
 
-def run_one_module(lib_file: str, dir_file: str, run_mode: RunMode, extra_args: list, conf):
+class JfeJob(object):
     """
-    Running one module with JFE
+    One independent mapfej invocation, its output location is fixed when the job is planned
     """
-    logger = XcalLogger("run-jfe-with-lib-lists", "run_one_module, with lib: %s, dir : %s" % (lib_file, dir_file))
-    lib_list = read_file(lib_file)
-    dir_list = read_file(dir_file)
+
+    def __init__(self, module: str, run_mode: RunMode, args: list, output_file: str, cache_key: str = None):
+        self.module = module
+        self.run_mode = run_mode
+        self.args = args
+        self.output_file = output_file
+        self.cache_key = cache_key
+        self.fanout = []  # Other output files receiving the same object
+        self.modules = [module]  # All modules using the object
+        self.manifest = None  # Inputs fingerprint of an application object, written once it is generated
+        self.error = None
+        self.duration = 0.0
+
+    def describe(self):
+        if len(self.modules) > 1:
+            return "%s (+%d modules) [%s] -> %s" % (self.module, len(self.modules) - 1, self.run_mode.name,
+                                                    self.output_file)
+        return "%s [%s] -> %s" % (self.module, self.run_mode.name, self.output_file)
+
+
+def module_key(lib_file: str):
+    """
+    Identify the module of a .lib.list file by its path without suffix, as module names may repeat across directories
+    """
+    if lib_file.endswith(LIB_LIST_SUFFIX):
+        return lib_file[:-len(LIB_LIST_SUFFIX)]
+    return lib_file
+
+
+def plan_one_module(lib_file: str, dir_file: str, run_mode: RunMode, extra_args: list, conf,
+                    planned_outputs: set = None):
+    """
+    Plan the JFE invocations of one module without running them
+    :param planned_outputs: output files already claimed by other jobs, shared among modules
+    :return: (list of JfeJob, list of entries for the .lib.output.list, None in Application mode)
+    """
+    if planned_outputs is None:
+        planned_outputs = set()
+
+    # Library V-Table Mode
+    if run_mode == RunMode.LibraryVtable:
+        jobs, lib_outputs = plan_library_jobs([lib_file], conf, planned_outputs)
+        return jobs, lib_outputs[lib_file]
+
+    logger = XcalLogger("run-jfe-with-lib-lists", "plan_one_module, with lib: %s, dir : %s" % (lib_file, dir_file))
+    lib_list = read_list_file(lib_file, conf)
+    dir_list = read_list_file(dir_file, conf)
+    module = module_key(lib_file)
 
     all_args = []
     jfe_script = conf.jfescript.name
@@ -405,98 +723,444 @@ def run_one_module(lib_file: str, dir_file: str, run_mode: RunMode, extra_args:
         all_args.append("-logLevel=ALL")
 
     # Application Mode
-    if run_mode == RunMode.Application:
-        all_args.append("-allow-phantom-refs=true")
-        base_name = os.path.basename(lib_file)
-        t_base_name = base_name.replace(".lib.list", "") + ".o"
-        output_file = os.path.join(output_dir, t_base_name)
-
-        for one_dir in dir_list:
-            if not os.path.exists(one_dir):
-                raise XcalException("run-jfe", "run_one_module", "class-file dir: '%s' does not exist" % one_dir,
-                                    TaskErrorNo.E_VERIFY_LIB_NOT_EXIST)
-            all_args.append("-fD," + one_dir)
+    all_args.append("-allow-phantom-refs=true")
+    base_name = os.path.basename(lib_file)
+    t_base_name = base_name.replace(".lib.list", "") + ".o"
+    output_file = os.path.join(output_dir, t_base_name)
+
+    for one_dir in dir_list:
+        if not os.path.exists(one_dir):
+            raise XcalException("run-jfe", "run_one_module", "class-file dir: '%s' does not exist" % one_dir,
+                                TaskErrorNo.E_VERIFY_LIB_NOT_EXIST)
+        all_args.append("-fD," + one_dir)
+
+    for one_lib in lib_list:
+        # Lib could be dir or Jar archives.
+        if not os.path.exists(one_lib):
+            raise XcalException("run-jfe", "run_one_module", "library '%s' does not exist" % one_lib,
+                                TaskErrorNo.E_VERIFY_LIB_NOT_EXIST)
+        all_args.append("-cp=" + one_lib)
+
+    all_args.append("-fB," + output_file)
+
+    for one_extra_arg in extra_args:
+        all_args.append(one_extra_arg)
+
+    planned_outputs.add(output_file)
+    manifest_file = output_file + MANIFEST_SUFFIX
+    old_manifest = read_manifest(manifest_file)
+    manifest = module_manifest(all_args, dir_list + lib_list, old_manifest)
+    if not conf.force and os.path.exists(output_file) and same_manifest(manifest, old_manifest):
+        logger.info("application up-to-date", " : " + output_file)
+        if manifest != old_manifest:
+            # Touched but unchanged files, remember their new mtimes to not hash them again
+            write_manifest(manifest_file, manifest)
+        return [], None
+
+    logger.info("application generation", " : " + output_file)
+    one_job = JfeJob(module, run_mode, all_args, output_file)
+    one_job.manifest = manifest
+    # Only a successful run writes a new manifest
+    if os.path.exists(manifest_file):
+        os.remove(manifest_file)
+    return [one_job], None
+
+
+def read_manifest(manifest_file: str):
+    if not os.path.isfile(manifest_file):
+        return None
+    try:
+        with open(manifest_file, "r") as f:
+            return json.load(f)
+    except ValueError:
+        return None
 
-        for one_lib in lib_list:
-            # Lib could be dir or Jar archives.
-            if not os.path.exists(one_lib):
-                raise XcalException("run-jfe", "run_one_module", "library '%s' does not exist" % one_lib,
-                                    TaskErrorNo.E_VERIFY_LIB_NOT_EXIST)
-            all_args.append("-cp=" + one_lib)
 
-        all_args.append("-fB," + output_file)
+def module_manifest(all_args: list, inputs: list, old_manifest: dict = None):
+    """
+    Fingerprint the inputs of an application object: the jfe command line and identity,
+    and the size, mtime and hash of every class file and library.
+    Hashes of files whose size and mtime did not change are taken from the old manifest.
+    """
+    old_files = old_manifest.get("files", {}) if old_manifest is not None else {}
+    files = {}
+    for one_input in inputs:
+        if os.path.isdir(one_input):
+            paths = []
+            for root, dirs, filenames in os.walk(one_input):
+                paths.extend(os.path.join(root, filename) for filename in filenames)
+            get_hash = HashUtility.get_sha256_hash
+        else:
+            # Jars are shared by many modules, hash each of them once per run
+            paths = [one_input]
+            get_hash = get_library_hash
+        for one_path in sorted(paths):
+            stat = os.stat(one_path)
+            old_entry = old_files.get(one_path)
+            if old_entry is not None and old_entry[0] == stat.st_size and old_entry[1] == stat.st_mtime_ns:
+                files[one_path] = old_entry
+            else:
+                files[one_path] = [stat.st_size, stat.st_mtime_ns, get_hash(one_path)]
+    return {"args": all_args, "jfe": get_jfe_identity(all_args[0]), "files": files}
+
 
-        for one_extra_arg in extra_args:
-            all_args.append(one_extra_arg)
+def same_manifest(manifest: dict, old_manifest: dict):
+    """
+    Compare two manifests by content, ignoring mtimes, so that touched but unchanged files do not count
+    """
+    if old_manifest is None:
+        return False
+    if manifest["args"] != old_manifest.get("args") or manifest["jfe"] != old_manifest.get("jfe"):
+        return False
+    old_files = old_manifest.get("files", {})
+    if manifest["files"].keys() != old_files.keys():
+        return False
+    return all(entry[2] == old_files[one_path][2] for one_path, entry in manifest["files"].items())
 
-        logger.info("application generation", " : " + output_file)
-        run_jfe_cmd(all_args, conf)
 
-    # Library V-Table Mode
-    elif run_mode == RunMode.LibraryVtable:
-        all_args.append("-allow-phantom-refs=true")
-        all_args.append("-VTABLE=true")
-        all_args.append("-libGenOnly=true")
-        all_results = []
+def write_manifest(manifest_file: str, manifest: dict):
+    tmp_file = manifest_file + ".tmp"
+    with open(tmp_file, "w") as f:
+        json.dump(manifest, f)
+    os.replace(tmp_file, manifest_file)
 
-        # From XcalAgent.JavaPreScanTask
-        all_target_names = set()
-        all_dirs_dict = {}
-        all_libs_dict = {}
 
-        for one_lib in lib_list:
-            if not os.path.exists(one_lib):
-                raise XcalException("run-jfe", "run_one_module", "library '%s' does not exist" % one_lib,
+def library_output_file(output_dir: str, one_lib: str, claimed_outputs: dict):
+    """
+    Name the object of a library in the output directory of a module.
+    A library whose object name is claimed by another library, in this module or in another
+    module sharing the output directory, gets a path hash suffix.
+    :param claimed_outputs: {output file: library} of all modules planned so far
+    """
+    if os.path.isdir(one_lib):
+        t_base_name = hashlib.md5(one_lib.encode()).hexdigest()
+    else:
+        t_base_name = os.path.basename(one_lib).replace(".", "-")
+
+    one_lib_output = os.path.join(output_dir, t_base_name + ".o")
+    if claimed_outputs.get(one_lib_output, one_lib) != one_lib:
+        path_hash = hashlib.md5(one_lib.encode()).hexdigest()[:8]
+        one_lib_output = os.path.join(output_dir, "%s-%s.o" % (t_base_name, path_hash))
+    claimed_outputs[one_lib_output] = one_lib
+    return one_lib_output
+
+
+def plan_library_jobs(lib_files: list, conf, planned_outputs: set = None, failed_modules: dict = None):
+    """
+    Plan the library objects of many modules at once, from the union of their .lib.list files.
+    Every unique library gets exactly one JFE job, and its object is placed into
+    the output directory of each module using it when the job finishes.
+    :param lib_files: the .lib.list files of the modules
+    :param planned_outputs: output files already claimed by other jobs
+    :param failed_modules: filled with {module: error} of the modules listing a missing library,
+                           which are left out of the plan; None to raise instead
+    :return: (list of JfeJob, {lib_file: list of entries for its .lib.output.list})
+    """
+    logger = XcalLogger("run-jfe-with-lib-lists", "plan_library_jobs")
+    if planned_outputs is None:
+        planned_outputs = set()
+
+    all_args = []
+    jfe_script = conf.jfescript.name
+    all_args.append(jfe_script)
+
+    if (conf.verbose == True):
+        all_args.append("-logLevel=ALL")
+
+    all_args.append("-allow-phantom-refs=true")
+    all_args.append("-VTABLE=true")
+    all_args.append("-libGenOnly=true")
+    cache = get_object_cache(conf)
+    jfe_flags = [one_arg for one_arg in all_args[1:] if not one_arg.startswith("-logLevel")]
+
+    # library -> [(module, output file)] of all modules using it
+    lib_users = collections.OrderedDict()
+    lib_outputs = {}
+    claimed_outputs = {}
+    for lib_file in lib_files:
+        module = module_key(lib_file)
+        output_dir = os.path.dirname(lib_file)
+        all_results = []
+        lib_list = read_list_file(lib_file, conf)
+        missing = [one_lib for one_lib in lib_list if not os.path.exists(one_lib)]
+        if len(missing) > 0:
+            if failed_modules is None:
+                raise XcalException("run-jfe", "plan_library_jobs", "library '%s' does not exist" % missing[0],
                                     TaskErrorNo.E_VERIFY_LIB_NOT_EXIST)
+            failed_modules[module] = "library '%s' does not exist" % missing[0]
+            logger.warn("library-plan", "Skipping module %s: %s" % (module, failed_modules[module]))
+            continue
+        for one_lib in lib_list:
+            one_lib_output = library_output_file(output_dir, one_lib, claimed_outputs)
+            all_results.append(one_lib if os.path.isdir(one_lib) else one_lib_output)
+            lib_users.setdefault(one_lib, []).append((module, one_lib_output))
+        lib_outputs[lib_file] = all_results
+
+    logger.info("library-plan", "%d unique libraries used by %d modules" % (len(lib_users), len(lib_outputs)))
+    if cache is not None:
+        # All cache keys need the jar hashes
+        prefetch_library_hashes(one_lib for one_lib in lib_users if os.path.isfile(one_lib))
+
+    jobs = []
+    planned_keys = {}
+    small_libs = []
+    for one_lib, users in lib_users.items():
+        outputs = [one_output for _, one_output in users if one_output not in planned_outputs]
+        if len(outputs) == 0:
+            # Claimed by other jobs of this run
+            continue
+
+        cache_key = None
+        if cache is not None and not os.path.isdir(one_lib):
+            cache_key = ObjectCache.make_key(get_library_hash(one_lib), get_jfe_identity(jfe_script), *jfe_flags)
+            if all(cache.materialize(cache_key, one_output) for one_output in outputs):
+                continue
+            if cache_key in planned_keys:
+                # Same content as a library generated by another job of this run
+                planned_keys[cache_key].fanout.extend(outputs)
+                planned_keys[cache_key].modules.extend(module for module, _ in users)
+                planned_outputs.update(outputs)
+                continue
+        else:
+            existing = [one_output for one_output in outputs if os.path.exists(one_output)]
+            if len(existing) > 0:
+                # Generated by a previous run, shared with the modules lacking it
+                for one_output in outputs:
+                    if one_output not in existing:
+                        FileUtility.link_or_copy(existing[0], one_output)
+                continue
 
-            real_list = all_args.copy()
+        if (conf.batchsmall > 0 and not os.path.isdir(one_lib) and
+                os.path.getsize(one_lib) <= conf.batchsmall * 1024):
+            # Generated together with other small jars, see below
+            small_libs.append((one_lib, users, outputs))
+            planned_outputs.update(outputs)
+            continue
+
+        one_lib_output = outputs[0]
+        real_list = all_args.copy()
+        real_list.append(("-fD," if os.path.isdir(one_lib) else "-fC,") + one_lib)
+        real_list.append("-fB," + one_lib_output)
+        if cache_key is not None and os.path.exists(one_lib_output):
+            # May be linked to another cache entry, which mapfej must not overwrite in place
+            os.remove(one_lib_output)
+
+        logger.info("library generation", " : %s, used by %d modules" % (one_lib_output, len(users)))
+        one_job = JfeJob(users[0][0], RunMode.LibraryVtable, real_list, one_lib_output, cache_key)
+        one_job.fanout.extend(outputs[1:])
+        one_job.modules = [module for module, _ in users]
+        planned_outputs.update(outputs)
+        if cache_key is not None:
+            planned_keys[cache_key] = one_job
+        jobs.append(one_job)
+
+    # Small jars are batched into one JFE process each, paying the JVM start-up once per batch.
+    # Jars used by the same modules are batched together, so that a module only references
+    # batches of jars on its classpath, and adding a jar only changes the batch receiving it.
+    small_groups = collections.OrderedDict()
+    for one_small_lib in sorted(small_libs, key=lambda one_small_lib: one_small_lib[0]):
+        user_modules = tuple(sorted(set(module for module, _ in one_small_lib[1])))
+        small_groups.setdefault(user_modules, []).append(one_small_lib)
+    replacements = {}
+    for one_group in small_groups.values():
+        for one_batch in split_library_batches(one_group, max(1, conf.batchmax)):
+            one_job = plan_library_batch(one_batch, all_args, jfe_flags, cache, replacements)
+            if one_job is not None:
+                jobs.append(one_job)
+
+    if len(replacements) > 0:
+        # Modules reference the combined object of a batch once, instead of the objects of its jars
+        for lib_file, all_results in lib_outputs.items():
+            lib_outputs[lib_file] = list(collections.OrderedDict.fromkeys(
+                replacements.get(one_result, one_result) for one_result in all_results))
+
+    return jobs, lib_outputs
+
+
+def split_library_batches(small_libs: list, batch_max: int):
+    """
+    Split the small jars of a group into batches of about batch_max jars by their content hash,
+    so that the batch of a jar does not depend on the other jars, unless the number of batches changes
+    :param small_libs: list of (library, users, outputs) as for plan_library_batch
+    :return: list of non-empty batches
+    """
+    count = 1
+    while count * batch_max < len(small_libs):
+        count *= 2
+    buckets = [[] for _ in range(count)]
+    for one_small_lib in small_libs:
+        buckets[int(get_library_hash(one_small_lib[0])[:8], 16) % count].append(one_small_lib)
+    return [one_bucket for one_bucket in buckets if len(one_bucket) > 0]
 
-            base_name = os.path.basename(one_lib)
-            if os.path.isdir(one_lib):
-                t_base_name = hashlib.md5(one_lib.encode()).hexdigest()
-                output_dir = os.path.dirname(lib_file)
-                one_lib_output = os.path.join(output_dir, t_base_name + ".o")
-                all_results.append(one_lib)
-                real_list.append("-fD," + one_lib)
-            else:
-                t_base_name = base_name.replace(".", "-")
-                output_dir = os.path.dirname(lib_file)
-                one_lib_output = os.path.join(output_dir, t_base_name + ".o")
-                all_results.append(one_lib_output)
-                real_list.append("-fC," + one_lib)
 
-            if os.path.exists(one_lib_output):
+def remove_stale_batches(output_dirs: list, referenced: set, logger: XcalLogger):
+    """
+    Remove the combined objects in output_dirs with their ir_b2a results, once the object lists are written,
+    unless referenced by the plan or by any object list in their directory, e.g. of a module not in this run
+    or whose jobs failed
+    """
+    for output_dir in output_dirs:
+        listed = set(referenced)
+        for one_list in glob.glob(os.path.join(glob.escape(output_dir), "*" + LIB_OUTPUT_LIST_SUFFIX)):
+            listed.update(read_file(one_list))
+        for one_batch in glob.glob(os.path.join(glob.escape(output_dir), BATCH_PREFIX + "*.o")):
+            if one_batch in listed:
                 continue
+            logger.info("remove-stale-batch", " : " + one_batch)
+            for one_path in (one_batch, one_batch + ".W", one_batch + ".W.list"):
+                if os.path.exists(one_path):
+                    os.remove(one_path)
 
-            real_list.append("-fB," + one_lib_output)
 
-            logger.info("library generation", " : " + one_lib_output)
-            run_jfe_cmd(real_list, conf)
-            pass
+def plan_library_batch(batch: list, all_args: list, jfe_flags: list, cache, replacements: dict):
+    """
+    Plan one JFE job generating a single combined object for several small jars
+    :param batch: list of (library, [(module, output file)] of its users, output files to generate)
+    :param replacements: filled with the output file of each jar -> the combined object in the same directory
+    :return: JfeJob, or None if the combined object is already available
+    """
+    logger = XcalLogger("run-jfe-with-lib-lists", "plan_library_batch")
+    jfe_script = all_args[0]
+    lib_hashes = sorted(get_library_hash(one_lib) for one_lib, _, _ in batch)
+    batch_key = ObjectCache.make_key("batch", get_jfe_identity(jfe_script), *(jfe_flags + lib_hashes))
+    batch_name = "%s%s.o" % (BATCH_PREFIX, batch_key[:16])
+
+    outputs = []
+    modules = []
+    for one_lib, users, _ in batch:
+        for module, one_output in users:
+            batch_output = os.path.join(os.path.dirname(one_output), batch_name)
+            replacements[one_output] = batch_output
+            if batch_output not in outputs:
+                outputs.append(batch_output)
+            if module not in modules:
+                modules.append(module)
+
+    if cache is not None:
+        if all(cache.materialize(batch_key, one_output) for one_output in outputs):
+            return None
+    else:
+        existing = [one_output for one_output in outputs if os.path.exists(one_output)]
+        if len(existing) > 0:
+            for one_output in outputs:
+                if one_output not in existing:
+                    FileUtility.link_or_copy(existing[0], one_output)
+            return None
+
+    real_list = all_args.copy()
+    for one_lib, _, _ in batch:
+        real_list.append("-fC," + one_lib)
+    real_list.append("-fB," + outputs[0])
+    if cache is not None and os.path.exists(outputs[0]):
+        os.remove(outputs[0])
+
+    logger.info("library batch generation", " : %s, %d jars used by %d modules" % (outputs[0], len(batch),
+                                                                                   len(modules)))
+    one_job = JfeJob(modules[0], RunMode.LibraryVtable, real_list, outputs[0],
+                     batch_key if cache is not None else None)
+    one_job.fanout.extend(outputs[1:])
+    one_job.modules = modules
+    return one_job
+
+
+def write_lib_output_list(lib_file: str, all_results: list):
+    """
+    Write the objects generated for the libraries of one module, in the order of its .lib.list
+    """
+    logger = XcalLogger("run-jfe-with-lib-lists", "write_lib_output_list")
+    lib_output_list_file = lib_file.replace(LIB_LIST_SUFFIX, LIB_OUTPUT_LIST_SUFFIX)
+    logger.info("writing-object-list", "Writing object list [%d] to : %s" % (len(all_results), lib_output_list_file))
+    with open(lib_output_list_file, "w+") as f:
+        for line in all_results:
+            f.write(line)
+            f.write("\n")
+
+
+def run_one_module(lib_file: str, dir_file: str, run_mode: RunMode, extra_args: list, conf):
+    """
+    Running one module with JFE
+    """
+    jobs, all_results = plan_one_module(lib_file, dir_file, run_mode, extra_args, conf)
+    for one_job in jobs:
+        run_jfe_cmd(one_job.args, conf)
+        finish_jfe_job(one_job, conf)
+
+    if run_mode == RunMode.LibraryVtable:
+        write_lib_output_list(lib_file, all_results)
+        remove_stale_batches([os.path.dirname(lib_file)], set(all_results),
+                             XcalLogger("run-jfe-with-lib-lists", "run_one_module"))
+
+
+def finish_jfe_job(job: JfeJob, conf):
+    """
+    Publish the object of a succeeded job to the library cache, and place it at the other outputs waiting for it
+    """
+    cache = get_object_cache(conf)
+    if cache is not None and job.cache_key is not None:
+        cache.publish(job.cache_key, job.output_file)
+    for one_output in job.fanout:
+        FileUtility.link_or_copy(job.output_file, one_output)
+    if job.manifest is not None:
+        write_manifest(job.output_file + MANIFEST_SUFFIX, job.manifest)
+
+
+def run_jfe_job(job: JfeJob, conf):
+    """
+    Run one planned job, recording its duration and error instead of raising
+    """
+    start = time.monotonic()
+    try:
+        run_jfe_cmd(job.args, conf)
+        finish_jfe_job(job, conf)
+    except Exception as err:
+        job.error = err
+    job.duration = time.monotonic() - start
+    return job
+
+
+def run_jfe_jobs(jobs: list, conf, logger: XcalLogger):
+    """
+    Run the planned jobs on a pool of conf.jobs workers, each worker drives one mapfej subprocess.
+    A failing job does not stop the others unless conf.failfast is set.
+    :return: list of failed jobs
+    """
+    workers = max(1, int(conf.jobs))
+    failed_jobs = []
+    logger.info("run-jfe-jobs", "Running %d jobs with %d workers" % (len(jobs), workers))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(run_jfe_job, one_job, conf) for one_job in jobs]
+        for future in as_completed(futures):
+            one_job = future.result()
+            if one_job.error is None:
+                logger.info("job-finished", "%s in %.1fs" % (one_job.describe(), one_job.duration))
+                continue
+
+            failed_jobs.append(one_job)
+            logger.warn("job-failed", "%s in %.1fs: %s" % (one_job.describe(), one_job.duration,
+                                                            getattr(one_job.error, "message", one_job.error)))
+            if conf.failfast:
+                for pending in futures:
+                    pending.cancel()
+                break
+
+    # With failfast, jobs already running when the loop stopped may have failed since
+    for one_job, future in zip(jobs, futures):
+        if future.cancelled():
+            one_job.error = "cancelled"
+        elif one_job.error is not None and one_job not in failed_jobs:
+            logger.warn("job-failed", "%s in %.1fs: %s" % (one_job.describe(), one_job.duration,
+                                                            getattr(one_job.error, "message", one_job.error)))
+        if one_job.error is not None and one_job not in failed_jobs:
+            failed_jobs.append(one_job)
+    return failed_jobs
 
-        lib_output_list_file = lib_file.replace(".lib.list", ".lib.output.list")
-        logger.info("writing-object-list", "Writing object list [%d] to : %s" % (len(all_results), lib_output_list_file))
-        with open(lib_output_list_file, "w+") as f:
-            for line in all_results:
-                f.write(line)
-                f.write("\n")
 
 # Run JFE with command line list
 def run_jfe_cmd(all_args: list, conf):
     logger = XcalLogger("run-jfe-with-lib-lists", "run_jfe_cmd")
-    log_file = os.path.join(os.path.abspath(os.curdir), "run-jfe.log")
+    log_file = get_jfe_log_file(all_args, conf)
     timeout = int(conf.timeout)
 
-    trial_times = 0
-    while not(get_system_info_ready()) :
-        rand_duration = int(random.uniform(10, 200))
-        logger.info("system-not-ready", "System resource is not available right now, sleep for %d" % rand_duration)
-        time.sleep(rand_duration)
-        trial_times += 1
-        if (trial_times > 90):
-            logger.info("forces-continue", "Tried to wait for 90 cycles, but couldn't wait until system's free. continue anyway")
-            break
-    
     # Quote all items
     safe_args = []
     for it in all_args:
@@ -514,29 +1178,58 @@ def run_jfe_cmd(all_args: list, conf):
     for key, val in custom_env.items():
         envs[key] = val
 
-    # run jfe
-    logger.info("start jfe ..", "")
-    res = CommandLineUtility.bash_execute(cmdline, timeout=timeout, environment=envs,
-                                          logger=logger, logfile=log_file)
+    # run jfe, once its heap fits into the memory budget
+    output_tail = OutputTail(MAX_LOG_DUMP_SIZE)
+    heap_mb = MemoryAdmissionController.parse_jvm_heap(custom_env["JVM_HEAP"])
+    try:
+        with get_admission_controller(conf).reserve(heap_mb):
+            logger.info("start jfe ..", "")
+            res = CommandLineUtility.bash_execute(cmdline, timeout=timeout, environment=envs,
+                                                  logger=logger, logfile=log_file, output_tail=output_tail)
+    except XcalException:
+        dump_jfe_output(output_tail, log_file, conf)
+        raise
 
     logger.info("jfe  finished ..", " %d " % res)
     if res != 0:
-        with open(log_file, "r") as f:
-            f.seek(0, 2)
-            if (f.tell() > MAX_LOG_DUMP_SIZE):
-                f.seek(MAX_LOG_DUMP_SIZE, 2)
-            else:
-                f.seek(0, 0)
-            log_content = f.read()
-            logging.error("--------------------------------------------------")
-            logging.warning(log_content)
-            logging.error("--------------------------------------------------")
+        log_file = dump_jfe_output(output_tail, log_file, conf)
         logger.warn("jfe  finished ..", " %d " % res)
         logger.error("run-jfe-with-lib-lists", "run_jfe_cmd", "Please look the log up at file: %s" % log_file)
         raise XcalException("run-jfe-with-lib-lists", "run_jfe_cmd",
                             "mapfej returned non-zero %d .. failed" % res,
                             TaskErrorNo.E_VERIFY_JFE)
 
+    if conf.compresslogs:
+        CompressionUtility.gzip_file(log_file)
+
+
+def get_jfe_log_file(all_args: list, conf):
+    """
+    Name the log file of one jfe invocation after its output object, in conf.logdir
+    """
+    output_file = "run-jfe"
+    for one_arg in all_args:
+        if one_arg.startswith("-fB,"):
+            output_file = one_arg[len("-fB,"):]
+    log_dir = os.path.abspath(conf.logdir)
+    os.makedirs(log_dir, exist_ok=True)
+    return os.path.join(log_dir, "%s.%s.log" % (os.path.basename(output_file),
+                                                hashlib.md5(output_file.encode()).hexdigest()[:8]))
+
+
+def dump_jfe_output(output_tail: OutputTail, log_file: str, conf):
+    """
+    Report the last output of a failed jfe from memory, then close its log file
+    :return: (str) the final log file path
+    """
+    logging.error("--------------------------------------------------")
+    logging.warning(output_tail.getvalue().decode("UTF-8", errors="replace"))
+    logging.error("--------------------------------------------------")
+    if conf.compresslogs:
+        return CompressionUtility.gzip_file(log_file)
+    return log_file
+
+
 def setup_logging():
     work_dir = os.curdir
     logging.getLogger('').handlers = []
@@ -564,37 +1257,103 @@ def main():
     else:
         runmode = RunMode.LibraryVtable
 
-    if (args.wholedir is not None):
-        process_whole_dir(args, config, logger)
-    elif args.liblist is not None and args.dirlist is not None:
-        run_one_module(args.liblist.name, args.dirlist.name, runmode, [], config)
+    if args.command == "stats":
+        print(ObjectCache(args.cachedir, logger).report())
+        return
 
+    hash_cache.get(config)
 
-def process_whole_dir(args, config, logger):
-    candidates_lib = []
-    candidates_dir = []
-    for subdir, dirs, files in os.walk(args.wholedir):
-        for filename in files:
-            filepath = os.path.join(subdir, filename)
-            if filepath.endswith(".lib.list"):
-                candidates_lib.append(filepath[:filepath.rfind(".lib.list")])
-            elif filepath.endswith(".dir.list"):
-                candidates_dir.append(filepath[:filepath.rfind(".dir.list")])
-            pass
-        pass
-    viable_candidates = [value for value in candidates_dir if value in candidates_lib]
-    if len(candidates_dir) != len(candidates_lib) or len(candidates_lib) != len(viable_candidates):
+    if args.command == "collect":
+        try:
+            CollectDependentBytecodeTasks(logger, get_module_index(config), tuple(args.prune.split(",")),
+                                          args.scanworkers).run(args.wholedir, args.tarball, args.compression,
+                                                                args.compresslevel, args.incremental, args.delta)
+        finally:
+            module_index.close()
+            hash_cache.close()
+        return
+
+    try:
+        if (args.wholedir is not None):
+            process_whole_dir(args, config, logger)
+        elif args.liblist is not None and args.dirlist is not None:
+            run_one_module(args.liblist.name, args.dirlist.name, runmode, [], config)
+    finally:
+        object_cache.close()
+        module_index.close()
+        hash_cache.close()
+
+
+def find_module_candidates(artifact_root: str, logger: XcalLogger, prune_patterns: tuple = DEFAULT_PRUNE_PATTERNS,
+                           workers: int = 1):
+    """
+    Find the modules in artifact_root having both a .lib.list and a .dir.list
+    file generated by the plugin, in one pass over the tree.
+    :return: sorted list of module path prefixes, i.e. the list file paths without their suffix
+    """
+    viable_candidates, lib_only, dir_only = ArtifactDiscovery.find_list_pairs(artifact_root, prune_patterns, workers)
+    if len(lib_only) > 0 or len(dir_only) > 0:
         logger.warn("find-candidates",
-                    "Cannot find adequate candidates since len[candidates-dir] = %d, len[candidates-lib] = %d " %
-                    (len(candidates_dir), len(candidates_lib)))
+                    "Cannot find equal candidates among lib and dir files, "
+                    "since len[viable-candidates] = %d, len[candidates-dir] = %d, len[candidates-lib] = %d " %
+                    (len(viable_candidates), len(viable_candidates) + len(dir_only),
+                     len(viable_candidates) + len(lib_only)))
+    return viable_candidates
+
+
+def process_whole_dir(args, config, logger):
+    viable_candidates = find_module_candidates(args.wholedir, logger, tuple(args.prune.split(",")),
+                                               args.scanworkers)
+
+    # Plan every module first, so that each output file is claimed by exactly one job
+    # A module failing to plan, e.g. because of a missing input, is reported at the end without stopping the others
+    all_jobs = []
+    lib_files = []
+    planned_outputs = set()
+    failed_plans = {}
     for one_lib_file in viable_candidates:
         if (os.path.exists(one_lib_file + ".lib.list") and
                 os.path.exists(one_lib_file + ".dir.list")):
-            run_one_module(one_lib_file + ".lib.list",
-                           one_lib_file + ".dir.list", RunMode.Application, [], config)
-
-            run_one_module(one_lib_file + ".lib.list",
-                           one_lib_file + ".dir.list", RunMode.LibraryVtable, [], config)
+            try:
+                app_jobs, _ = plan_one_module(one_lib_file + ".lib.list", one_lib_file + ".dir.list",
+                                              RunMode.Application, [], config, planned_outputs)
+            except XcalException as err:
+                module = module_key(one_lib_file + ".lib.list")
+                failed_plans[module] = err.message
+                logger.warn("plan-failed", "Skipping module %s: %s" % (module, err.message))
+                continue
+            all_jobs.extend(app_jobs)
+            lib_files.append(one_lib_file + ".lib.list")
+
+    # Then the libraries of all modules together, one job per unique library
+    lib_jobs, lib_outputs = plan_library_jobs(lib_files, config, planned_outputs, failed_plans)
+    all_jobs.extend(lib_jobs)
+
+    failed_jobs = run_jfe_jobs(all_jobs, config, logger)
+
+    # A module's object list is only valid if none of its jobs failed, and no object is missing
+    # because the job generating it failed or got cancelled
+    failed_modules = set()
+    for one_job in failed_jobs:
+        failed_modules.update(one_job.modules)
+    for lib_file, all_results in lib_outputs.items():
+        module = module_key(lib_file)
+        if module in failed_modules or not all(os.path.exists(one_result) for one_result in all_results):
+            logger.warn("skip-object-list", "Not writing object list for %s, some jobs failed" % module)
+            continue
+        write_lib_output_list(lib_file, all_results)
+    remove_stale_batches(sorted(set(os.path.dirname(lib_file) for lib_file in lib_outputs)),
+                         set(one_result for all_results in lib_outputs.values() for one_result in all_results), logger)
+
+    if len(failed_jobs) > 0 or len(failed_plans) > 0:
+        for module, error in sorted(failed_plans.items()):
+            logger.error("run-jfe", "process_whole_dir", "failed module: %s, %s" % (module, error))
+        for one_job in failed_jobs:
+            logger.error("run-jfe", "process_whole_dir", "failed job: %s" % one_job.describe())
+        raise XcalException("run-jfe", "process_whole_dir",
+                            "%d of %d jfe jobs failed, %d modules could not be planned" %
+                            (len(failed_jobs), len(all_jobs), len(failed_plans)),
+                            TaskErrorNo.E_VERIFY_JFE)
 
 
 if __name__ == "__main__":